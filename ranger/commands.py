@@ -1,5 +1,4 @@
 from __future__ import absolute_import, division, print_function
-from collections import deque
 import collections
 import os
 import re
@@ -10,6 +9,10 @@ import warnings
 warnings.filterwarnings("ignore")
 
 from ranger.api.commands import Command
+from ranger.core.loader import Loadable
+from ranger.core.metadata import MetadataManager
+from ranger.core.shared import FileManagerAware
+from ranger.ext.openstruct import DefaultOpenStruct
 
 URL = collections.namedtuple("URL", ["user", "hostname", "path"])
 
@@ -41,6 +44,328 @@ class echo(Command):
         self.fm.notify(self.rest(1))
 
 
+class DirectoryIndex(object):
+    """An on-disk index of subdirectory names, used by cd tab completion.
+
+    Every entry maps an absolute path to its mtime and the names of its
+    subdirectories.  Lookups are served from memory; paths that have been
+    looked up are revalidated against their mtime (and their children are
+    prefetched) by a background task, so slow filesystems are only touched
+    outside of the keypress.
+    """
+
+    max_entries = 100000
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = {}
+        self.stale = set()
+        self.prefetch = set()
+        self.changed = False
+        self._load()
+
+    def _load(self):
+        import json
+
+        if not self.filename:
+            return
+        try:
+            with open(self.filename, "r") as fobj:
+                self.entries = dict(
+                    (path, entry)
+                    for path, entry in json.load(fobj).items()
+                    if isinstance(entry, list) and len(entry) == 2
+                )
+        except (OSError, IOError, ValueError, AttributeError):
+            self.entries = {}
+
+    def save(self):
+        import json
+
+        self.changed = False
+        if not self.filename:
+            return
+        tmpname = self.filename + ".tmp"
+        try:
+            with open(tmpname, "w") as fobj:
+                json.dump(self.entries, fobj, separators=(",", ":"))
+            os.rename(tmpname, self.filename)
+        except (OSError, IOError):
+            pass
+
+    def subdirs(self, path):
+        """Return the subdirectory names of path, from memory if possible
+
+        Raises OSError if path is not indexed and can't be read.
+        """
+        entry = self.entries.get(path)
+        if entry is None:
+            entry = self._scan(path)
+        else:
+            self.stale.add(path)
+        return entry[1]
+
+    def has_work(self):
+        return bool(self.stale or self.prefetch)
+
+    def _scan(self, path, prefetch_children=True):
+        mtime = os.stat(path).st_mtime
+        names = []
+        for entry in os.scandir(path):
+            try:
+                if entry.is_dir():
+                    names.append(entry.name)
+            except OSError:
+                continue
+        if len(self.entries) >= self.max_entries:
+            del self.entries[next(iter(self.entries))]
+        self.entries.pop(path, None)
+        self.entries[path] = [mtime, names]
+        if prefetch_children:
+            self.prefetch.update(
+                os.path.join(path, name)
+                for name in names
+                if os.path.join(path, name) not in self.entries
+            )
+        self.changed = True
+        return self.entries[path]
+
+    def refresh(self):
+        """Revalidate stale entries and index prefetched ones, step by step"""
+        while self.stale or self.prefetch:
+            looked_up = bool(self.stale)
+            path = self.stale.pop() if looked_up else self.prefetch.pop()
+            entry = self.entries.get(path)
+            try:
+                if entry is None or entry[0] != os.stat(path).st_mtime:
+                    self._scan(path, prefetch_children=looked_up)
+            except OSError:
+                if self.entries.pop(path, None) is not None:
+                    self.changed = True
+            yield
+        if self.changed:
+            self.save()
+
+
+class DirectoryIndexLoader(Loadable, FileManagerAware):
+    """Background task that keeps a DirectoryIndex up to date"""
+
+    def __init__(self, index):
+        self.index = index
+        Loadable.__init__(self, self.index.refresh(), "Indexing directories...")
+
+
+class FuzzyMatcher(object):
+    """Scores candidates that contain the query as a subsequence.
+
+    Matches on word boundaries, runs of consecutive matches and matches at
+    the very start score higher, gaps between matched characters cost
+    points.  Like fzf's first algorithm, the match is found with a forward
+    and a backward pass of str.find/rfind, so scoring costs O(len(query))
+    per candidate.  Lowercased names and boundary flags are computed once
+    per candidate and cached.
+    """
+
+    score_match = 16
+    bonus_prefix = 24
+    bonus_boundary = 8
+    bonus_consecutive = 8
+    penalty_gap_start = 3
+    penalty_gap_extension = 1
+    max_cached = 500000
+
+    # The last character of each match starts a word: after a run of
+    # separators or on a camelCase hump
+    BOUNDARY_RE = re.compile(r"[ \-_.+/]+[^ \-_.+/]|[a-z][A-Z]")
+
+    def __init__(self):
+        self._prepared = {}
+
+    def prepare(self, candidate):
+        """Return the lowercased candidate and its word boundary flags"""
+        try:
+            return self._prepared[candidate]
+        except KeyError:
+            pass
+        if len(self._prepared) >= self.max_cached:
+            self._prepared.clear()
+
+        lower = candidate.lower()
+        if len(lower) != len(candidate):
+            lower = candidate
+        boundaries = bytearray(len(candidate))
+        if candidate:
+            boundaries[0] = 1
+        for match in self.BOUNDARY_RE.finditer(candidate):
+            boundaries[match.end() - 1] = 1
+        self._prepared[candidate] = result = (lower, boundaries)
+        return result
+
+    def compile(self, query, ignore_case=False):
+        """Return a function mapping a candidate to its score or None
+
+        The query is preprocessed once, so use this when scoring many
+        candidates against the same query.
+        """
+        # pylint: disable=too-many-locals
+        if ignore_case:
+            query = query.lower()
+        if not query:
+            return lambda candidate: 0
+
+        backwards = query[::-1]
+        last = len(query) - 1
+        prepared = self._prepared
+        prepare = self.prepare
+        score_all = self.score_match * len(query)
+        bonus_prefix = self.bonus_prefix
+        bonus_boundary = self.bonus_boundary
+        bonus_consecutive = self.bonus_consecutive
+        gap_start = self.penalty_gap_start - self.penalty_gap_extension
+        gap_extension = self.penalty_gap_extension
+
+        def score(candidate):
+            try:
+                lower, boundaries = prepared[candidate]
+            except KeyError:
+                lower, boundaries = prepare(candidate)
+            text = lower if ignore_case else candidate
+
+            pos = -1
+            for char in query:
+                pos = text.find(char, pos + 1)
+                if pos < 0:
+                    return None
+
+            # Walk back from the end of the match to find the tightest window
+            result = score_all
+            nxt = pos
+            for i, char in enumerate(backwards):
+                pos = text.rfind(char, 0, nxt + 1 if i == 0 else nxt)
+                if boundaries[pos]:
+                    result += bonus_boundary
+                if i:
+                    if nxt == pos + 1:
+                        result += bonus_consecutive
+                    else:
+                        result -= gap_start + gap_extension * (nxt - pos - 1)
+                nxt = pos
+                if i == last and pos == 0:
+                    result += bonus_prefix
+            return result
+
+        return score
+
+    def score(self, query, candidate, ignore_case=False):
+        """Return the score of candidate, or None if it doesn't match"""
+        return self.compile(query, ignore_case)(candidate)
+
+
+class Frecency(object):
+    """Visit counts and times of directories, ranked like z/zoxide do
+
+    The table is stored in a text file with one "count<TAB>time<TAB>path"
+    line per directory.
+    """
+
+    max_entries = 3000
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = {}
+        self._load()
+
+    def _load(self):
+        if not self.filename:
+            return
+        try:
+            with open(self.filename, "r") as fobj:
+                for line in fobj:
+                    try:
+                        count, atime, path = line.rstrip("\n").split("\t", 2)
+                        self.entries[path] = [float(count), float(atime)]
+                    except ValueError:
+                        continue
+        except (OSError, IOError):
+            pass
+
+    def save(self):
+        if not self.filename:
+            return
+        try:
+            with open(self.filename, "w") as fobj:
+                for path, (count, atime) in self.entries.items():
+                    fobj.write("%g\t%d\t%s\n" % (count, atime, path))
+        except (OSError, IOError):
+            pass
+
+    def visit(self, path):
+        from time import time
+
+        entry = self.entries.setdefault(path, [0, 0])
+        entry[0] += 1
+        entry[1] = time()
+        if len(self.entries) > self.max_entries:
+            now = time()
+            ranked = sorted(self.entries, key=lambda p: self.score(p, now))
+            for old in ranked[: len(ranked) // 10]:
+                del self.entries[old]
+        self.save()
+
+    def score(self, path, now=None):
+        entry = self.entries.get(path)
+        if entry is None:
+            return 0
+        if now is None:
+            from time import time
+
+            now = time()
+        age = now - entry[1]
+        if age < 3600:
+            return entry[0] * 4
+        if age < 86400:
+            return entry[0] * 2
+        if age < 604800:
+            return entry[0] / 2
+        return entry[0] / 4
+
+
+class BookmarkIndex(object):
+    """Bookmarked paths kept sorted, so the bookmarks inside a directory can
+    be found with a binary search.  The sorted list is only rebuilt when the
+    bookmarks change.
+    """
+
+    def __init__(self):
+        self._signature = None
+        self.paths = []
+
+    def update(self, bookmarks):
+        signature = tuple(value.path for value in bookmarks.dct.values())
+        if signature != self._signature:
+            self._signature = signature
+            self.paths = sorted(set(signature))
+
+    def __contains__(self, path):
+        from bisect import bisect_left
+
+        i = bisect_left(self.paths, path)
+        return i < len(self.paths) and self.paths[i] == path
+
+    def below(self, directory):
+        """Return the bookmarked paths inside directory"""
+        from bisect import bisect_left
+
+        prefix = directory + os.path.sep
+        paths = self.paths
+        i = bisect_left(paths, prefix)
+        result = []
+        while i < len(paths) and paths[i].startswith(prefix):
+            result.append(paths[i])
+            i += 1
+        return result
+
+
 class cd(Command):
     """:cd [-r] <path>
 
@@ -63,10 +388,13 @@ class cd(Command):
         if not destination:
             destination = "~"
 
+        previous = self.fm.thisdir
         if destination == "-":
             self.fm.enter_bookmark("`")
         else:
             self.fm.cd(destination)
+        if self.fm.thisdir is not previous:
+            self._get_frecency().visit(self.fm.thisdir.path)
 
     def _tab_args(self):
         # dest must be rest because path could contain spaces
@@ -92,64 +420,109 @@ class cd(Command):
             dest.endswith(os.path.sep),
         )
 
-    @staticmethod
-    def _tab_paths(dest, dest_abs, ends_with_sep):
+    index_filename = "cd_index"
+    frecency_filename = "cd_frecency"
+    bookmark_bonus = 16
+    frecency_weight = 8
+    _index = None
+    _index_loader = None
+    _frecency = None
+    matcher = FuzzyMatcher()
+    bookmark_index = BookmarkIndex()
+
+    def __init__(self, *args, **kwargs):
+        super(cd, self).__init__(*args, **kwargs)
+        self._scores = {}
+
+    def _get_frecency(self):
+        if cd._frecency is None:
+            cd._frecency = Frecency(self.fm.datapath(self.frecency_filename))
+        return cd._frecency
+
+    def _subdirs(self, path):
+        """List the subdirectories of path using the shared DirectoryIndex"""
+        if cd._index is None:
+            cd._index = DirectoryIndex(self.fm.datapath(self.index_filename))
+        return list(cd._index.subdirs(os.path.normpath(path)))
+
+    def _isdir(self, path):
+        if cd._index is not None and os.path.normpath(path) in cd._index.entries:
+            return True
+        return os.path.isdir(path)
+
+    def _schedule_index_refresh(self):
+        if cd._index is None or not cd._index.has_work():
+            return
+        if cd._index_loader is None or cd._index_loader not in self.fm.loader.queue:
+            cd._index_loader = DirectoryIndexLoader(cd._index)
+            self.fm.loader.add(cd._index_loader, append=True)
+
+    def _tab_paths(self, dest, dest_abs, ends_with_sep):
         if not dest:
             try:
-                return next(os.walk(dest_abs))[1], dest_abs
-            except (OSError, StopIteration):
+                return self._subdirs(dest_abs), dest_abs
+            except OSError:
                 return [], ""
 
         if ends_with_sep:
             try:
                 return [
-                    os.path.join(dest, path) for path in next(os.walk(dest_abs))[1]
+                    os.path.join(dest, path) for path in self._subdirs(dest_abs)
                 ], ""
-            except (OSError, StopIteration):
+            except OSError:
                 return [], ""
 
         return None, None
 
-    def _tab_match(self, path_user, path_file):
-        if self.fm.settings.cd_tab_case == "insensitive":
-            path_user = path_user.lower()
-            path_file = path_file.lower()
-        elif self.fm.settings.cd_tab_case == "smart" and path_user.islower():
-            path_file = path_file.lower()
-        return path_file.startswith(path_user)
+    def _tab_match(self, path_user):
+        """Return a function scoring directory names against path_user"""
+        ignore_case = self.fm.settings.cd_tab_case == "insensitive" or (
+            self.fm.settings.cd_tab_case == "smart" and path_user.islower()
+        )
+        return self.matcher.compile(path_user, ignore_case)
 
     def _tab_normal(self, dest, dest_abs):
         dest_dir = os.path.dirname(dest)
         dest_base = os.path.basename(dest)
 
         try:
-            dirnames = next(os.walk(os.path.dirname(dest_abs)))[1]
-        except (OSError, StopIteration):
+            dirnames = self._subdirs(os.path.dirname(dest_abs))
+        except OSError:
             return [], ""
 
-        return [
-            os.path.join(dest_dir, d) for d in dirnames if self._tab_match(dest_base, d)
-        ], ""
+        match = self._tab_match(dest_base)
+        paths = []
+        for dirname in dirnames:
+            score = match(dirname)
+            if score is not None:
+                path = os.path.join(dest_dir, dirname)
+                self._scores[path] = score
+                paths.append(path)
+        return paths, ""
 
     def _tab_fuzzy_match(self, basepath, tokens):
         """Find directories matching tokens recursively"""
         if not tokens:
             tokens = [""]
         paths = [basepath]
+        scores = {basepath: 0}
         while True:
             token = tokens.pop()
+            match = self._tab_match(token)
             matches = []
             for path in paths:
                 try:
-                    directories = next(os.walk(path))[1]
-                except (OSError, StopIteration):
+                    directories = self._subdirs(path)
+                except OSError:
                     continue
-                matches += [
-                    os.path.join(path, d)
-                    for d in directories
-                    if self._tab_match(token, d)
-                ]
+                for directory in directories:
+                    score = match(directory)
+                    if score is not None:
+                        subpath = os.path.join(path, directory)
+                        scores[subpath] = scores[path] + score
+                        matches.append(subpath)
             if not tokens or not matches:
+                self._scores.update(scores)
                 return matches
             paths = matches
 
@@ -163,7 +536,7 @@ class cd(Command):
             basepath, token = os.path.split(basepath)
             if basepath == basepath_old:
                 break
-            if os.path.isdir(basepath_old) and not token.startswith("."):
+            if self._isdir(basepath_old) and not token.startswith("."):
                 basepath = basepath_old
                 break
             tokens.append(token)
@@ -171,14 +544,36 @@ class cd(Command):
         paths = self._tab_fuzzy_match(basepath, tokens)
         if not os.path.isabs(dest):
             paths_rel = self.fm.thisdir.path
-            paths = [
-                os.path.relpath(os.path.join(basepath, path), paths_rel)
-                for path in paths
-            ]
+            relpaths = []
+            for path in paths:
+                relpath = os.path.relpath(os.path.join(basepath, path), paths_rel)
+                self._scores[relpath] = self._scores.get(path, 0)
+                relpaths.append(relpath)
+            paths = relpaths
         else:
             paths_rel = ""
         return paths, paths_rel
 
+    def _rank(self, paths, paths_rel):
+        """Sort paths by match score, frecency and bookmarks, best first"""
+        from math import log
+        from time import time
+
+        now = time()
+        frecency = self._get_frecency()
+        bookmarked = self.bookmark_index
+        base = os.path.join(self.fm.thisdir.path, paths_rel)
+
+        def rank(path):
+            abspath = os.path.normpath(os.path.join(base, path))
+            score = self._scores.get(path, 0)
+            score += self.frecency_weight * log(1 + frecency.score(abspath, now), 2)
+            if abspath in bookmarked:
+                score += self.bookmark_bonus
+            return (-score, path)
+
+        paths.sort(key=rank)
+
     def tab(self, tabnum):
         from os.path import sep
 
@@ -191,16 +586,20 @@ class cd(Command):
             else:
                 paths, paths_rel = self._tab_normal(dest, dest_abs)
 
-        paths.sort()
+        self.bookmark_index.update(self.fm.bookmarks)
+        self._rank(paths, paths_rel)
 
         if self.fm.settings.cd_bookmarks:
             paths[0:0] = [
-                os.path.relpath(v.path, paths_rel) if paths_rel else v.path
-                for v in self.fm.bookmarks.dct.values()
+                os.path.relpath(bookmark, paths_rel) if paths_rel else bookmark
                 for path in paths
-                if v.path.startswith(os.path.join(paths_rel, path) + sep)
+                for bookmark in self.bookmark_index.below(
+                    os.path.join(paths_rel, path)
+                )
             ]
 
+        self._schedule_index_refresh()
+
         if not paths:
             return None
         if len(paths) == 1:
@@ -476,6 +875,331 @@ class setintag(set_):
         self.fm.set_option_from_string(name, value, tags=tags)
 
 
+class CachedLinemode(object):
+    """A linemode that remembers its strings for each file
+
+    The strings are kept on the file object, by linemode, along with the
+    stat data, size and settings they were made from, so they are only
+    computed again when one of those changes (or the day does, for the
+    relative times).  Linemodes that use metadata are left alone, their
+    input is not in the stat data.
+    """
+
+    # The date the relative times are made for, checked once a minute
+    _today = None
+    _check_today = 0
+    # Counts the changes of the settings that the strings depend on
+    _settings_version = 0
+    settings = ("size_in_bytes",)
+
+    def __init__(self, linemode):
+        self.linemode = linemode
+
+    def __getattr__(self, name):
+        return getattr(self.linemode, name)
+
+    def _strings(self, fobj, metadata):
+        from time import localtime, time
+
+        stat = fobj.stat
+        if stat is None or self.linemode.uses_metadata:
+            return None
+        now = time()
+        if now >= CachedLinemode._check_today:
+            CachedLinemode._today = localtime(now)[:3]
+            CachedLinemode._check_today = now + 60
+
+        # Directory sizes change without a new stat result, on loading the
+        # directory and on :dc, and size_in_bytes changes how sizes look
+        key = (
+            fobj.relative_path,
+            stat.st_mtime,
+            stat.st_size,
+            stat.st_ctime,
+            fobj.size,
+            CachedLinemode._settings_version,
+            CachedLinemode._today,
+        )
+        cache = fobj.__dict__.setdefault("linemode_cache", {})
+        cached = cache.get(self.linemode.name)
+        if cached is None or cached[0] != key:
+            try:
+                info = self.linemode.infostring(fobj, metadata)
+            except NotImplementedError:
+                info = NotImplementedError
+            cached = (key, self.linemode.filetitle(fobj, metadata), info)
+            cache[self.linemode.name] = cached
+        return cached
+
+    def filetitle(self, fobj, metadata):
+        cached = self._strings(fobj, metadata)
+        if cached is None:
+            return self.linemode.filetitle(fobj, metadata)
+        return cached[1]
+
+    def infostring(self, fobj, metadata):
+        cached = self._strings(fobj, metadata)
+        if cached is None:
+            return self.linemode.infostring(fobj, metadata)
+        if cached[2] is NotImplementedError:
+            raise NotImplementedError
+        return cached[2]
+
+
+def cache_linemodes(fm):
+    """Wrap the registered linemodes in CachedLinemode"""
+    from ranger.container.fsobject import FileSystemObject
+
+    if not CachedLinemode._settings_version:
+        CachedLinemode._settings_version = 1
+
+        def settings_changed():
+            CachedLinemode._settings_version += 1
+
+        for name in CachedLinemode.settings:
+            fm.settings.signal_bind("setopt." + name, settings_changed)
+    linemodes = FileSystemObject.linemode_dict
+    for name, linemode in list(linemodes.items()):
+        if not isinstance(linemode, CachedLinemode):
+            linemodes[name] = CachedLinemode(linemode)
+
+
+class PathRules(object):
+    """A run of consecutive path=<regexp> rules of default_linemode
+
+    Patterns that are just a string, maybe anchored with ^ and $, are
+    looked up in tables by prefix, suffix or whole path, or tested with
+    `in`; only the remaining ones are searched as regular expressions.
+    match() gives the linemode of the first rule that matches.
+    """
+
+    literal = re.compile(r"(\^?)((?:[^\\.^$*+?{}\[\]|()]|\\[^A-Za-z0-9])*)(\$?)\Z")
+
+    def __init__(self):
+        self.linemodes = []
+        self.exact = {}
+        self.prefixes = collections.defaultdict(dict)
+        self.suffixes = collections.defaultdict(dict)
+        self.substrings = []
+        self.regexps = []
+
+    def add(self, regexp, linemode):
+        i = len(self.linemodes)
+        self.linemodes.append(linemode)
+        match = self.literal.match(regexp.pattern)
+        if match is None or regexp.flags != re.UNICODE:
+            self.regexps.append((regexp, i))
+            return
+        begin, string, end = match.groups()
+        string = re.sub(r"\\(.)", r"\1", string)
+        if begin and end:
+            self.exact.setdefault(string, i)
+        elif begin:
+            self.prefixes[len(string)].setdefault(string, i)
+        elif end:
+            self.suffixes[len(string)].setdefault(string, i)
+        else:
+            self.substrings.append((string, i))
+
+    def _match_end(self, path, best):
+        i = self.exact.get(path)
+        if i is not None and i < best:
+            best = i
+        for length, table in self.suffixes.items():
+            i = table.get(path[len(path) - length:])
+            if i is not None and i < best:
+                best = i
+        return best
+
+    def match(self, path):
+        best = self._match_end(path, len(self.linemodes))
+        if path.endswith("\n"):
+            # "$" also matches before a newline at the end
+            best = self._match_end(path[:-1], best)
+        for length, table in self.prefixes.items():
+            i = table.get(path[:length])
+            if i is not None and i < best:
+                best = i
+        for string, i in self.substrings:
+            if i >= best:
+                break
+            if string in path:
+                best = i
+                break
+        for regexp, i in self.regexps:
+            if i >= best:
+                break
+            if regexp.search(path):
+                best = i
+                break
+        if best < len(self.linemodes):
+            return self.linemodes[best]
+        return None
+
+
+class LinemodeRules(object):
+    """fm.default_linemodes, compiled for choosing the linemode of a file
+
+    Runs of consecutive path=<regexp> rules become a PathRules, runs of
+    consecutive tag=<tags> rules one table from tag marker to linemode.
+    Which path rule matches first is cached by path, the tags are looked
+    up every time since they change.  Up to linear_limit path rules are
+    instead just searched in order like ranger does, which is faster for
+    so few than the tables and the cache.  The rules are compiled again
+    when default_linemode bumps the version, when fm.default_linemodes is
+    replaced or changes its length, or when a linemode is registered.
+    """
+
+    max_cache = 100000
+    linear_limit = 8
+    version = 0
+
+    def __init__(self):
+        self._source = self._length = self._version = self._count = None
+        self._always = None
+        self._steps = []
+        self._has_paths = False
+        self._linear = None
+        self._cache = {}
+
+    def compile(self, rules, linemodes):
+        """Turn the rules into steps: ("path", PathRules, None),
+        ("tag", linemodes by marker, None) or ("always", None, linemode)
+
+        With few path rules, the rules are kept as they are instead, with
+        the search method of the regexps: ("path", search, linemode).
+        """
+        rules = [rule for rule in rules if rule[2] in linemodes]
+        self._always = None
+        if rules and rules[0][0] == "always":
+            self._always = rules[0][2]
+        paths = sum(1 for rule in rules if rule[0] == "path")
+        if paths <= self.linear_limit:
+            self._linear = [
+                (method, argument.search if method == "path" else argument, mode)
+                for method, argument, mode in rules
+            ]
+            self._steps = []
+            self._has_paths = False
+            return
+        self._linear = None
+        steps = []
+        for method, argument, linemode in rules:
+            last = steps[-1][0] if steps else None
+            if method == "path":
+                if last != "path":
+                    steps.append(("path", PathRules(), None))
+                steps[-1][1].add(argument, linemode)
+            elif method == "tag":
+                if last != "tag":
+                    steps.append(("tag", {}, None))
+                for marker in argument:
+                    steps[-1][1].setdefault(marker, linemode)
+            elif method == "always":
+                steps.append((method, argument, linemode))
+                break
+        self._steps = steps
+        self._has_paths = any(step[0] == "path" for step in steps)
+        self._cache.clear()
+
+    def _first_path_match(self, path):
+        """The index of the first step with a path rule matching path, and
+        the linemode of that rule"""
+        found = self._cache.get(path)
+        if found is not None:
+            return found
+        found = (len(self._steps), None)
+        for i, (method, path_rules, _) in enumerate(self._steps):
+            if method == "path":
+                linemode = path_rules.match(path)
+                if linemode is not None:
+                    found = (i, linemode)
+                    break
+        if len(self._cache) >= self.max_cache:
+            self._cache.clear()
+        self._cache[path] = found
+        return found
+
+    def choose(self, fobj):
+        """The linemode for fobj, as FileSystemObject.linemode would pick it"""
+        fm = fobj.fm
+        rules = fm.default_linemodes
+        linemodes = fobj.linemode_dict
+        if (
+            rules is not self._source
+            or len(rules) != self._length
+            or LinemodeRules.version != self._version
+            or len(linemodes) != self._count
+        ):
+            self.compile(rules, linemodes)
+            self._source = rules
+            self._length = len(rules)
+            self._version = LinemodeRules.version
+            self._count = len(linemodes)
+
+        if self._always is not None:
+            return self._always
+
+        if self._linear is not None:
+            path = fobj.path
+            for method, argument, linemode in self._linear:
+                if method == "always":
+                    return linemode
+                if method == "path":
+                    if argument(path):
+                        return linemode
+                else:
+                    marker = self._marker(fm, fobj)
+                    if marker is not None and marker in argument:
+                        return linemode
+            return self._default()
+
+        steps = self._steps
+        if self._has_paths:
+            first, path_linemode = self._first_path_match(fobj.path)
+        else:
+            first, path_linemode = len(steps), None
+        marker = False
+        for method, argument, linemode in steps[:first]:
+            if method == "tag":
+                if marker is False:
+                    marker = self._marker(fm, fobj)
+                if marker in argument:
+                    return argument[marker]
+            elif method == "always":
+                return linemode
+        return path_linemode or self._default()
+
+    @staticmethod
+    def _marker(fm, fobj):
+        if fm.tags and fobj.realpath in fm.tags:
+            return fm.tags.marker(fobj.realpath)
+        return None
+
+    @staticmethod
+    def _default():
+        from ranger.core.linemode import DEFAULT_LINEMODE
+
+        return DEFAULT_LINEMODE
+
+    rules = None
+
+    @classmethod
+    def install(cls):
+        """Let FileSystemObject.linemode choose through the compiled rules"""
+        from ranger.container.fsobject import FileSystemObject
+        from ranger.ext.lazy_property import lazy_property
+
+        if cls.rules is None:
+            cls.rules = cls()
+            choose = cls.rules.choose
+
+            def linemode(fobj):
+                return choose(fobj)
+
+            FileSystemObject.linemode = lazy_property(linemode)
+
+
 class default_linemode(Command):
 
     def execute(self):
@@ -509,9 +1233,16 @@ class default_linemode(Command):
                 bad=True,
             )
 
+        if lmode in FileSystemObject.linemode_dict:
+            if FileSystemObject.linemode_dict[lmode].uses_metadata:
+                metadata_index(self.fm)
+        cache_linemodes(self.fm)
+
         # Add the prepared entry to the fm.default_linemodes
         entry = [method, argument, lmode]
         self.fm.default_linemodes.appendleft(entry)
+        LinemodeRules.version += 1
+        LinemodeRules.install()
 
         # Redraw the columns
         if self.fm.ui.browser:
@@ -606,6 +1337,260 @@ class terminal(Command):
         self.fm.run(get_term(), flags="f")
 
 
+def is_directory_with_files(path):
+    """Is path a non-empty directory (and not a symlink to one)?
+
+    Only the first directory entry is read, instead of listing all of them.
+    Unreadable directories count as non-empty.
+    """
+    if not os.path.isdir(path) or os.path.islink(path):
+        return False
+    try:
+        iterator = os.scandir(path)
+    except OSError:
+        return True
+    try:
+        return next(iterator, None) is not None
+    finally:
+        iterator.close()
+
+
+class DeleteLoader(Loadable, FileManagerAware):
+    """Deletes files and directory trees in the background
+
+    The entries of the directories to delete are spread over a thread pool,
+    and every tree is removed bottom-up with unlink/rmdir relative to an
+    open directory file descriptor (unlinkat), so the kernel doesn't
+    resolve the full path of every single entry.  The progress is shown in
+    the task view; removing the task from there cancels the deletion.
+    """
+
+    progressbar_supported = True
+    max_workers = 8
+
+    def __init__(self, paths):
+        import threading
+
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.removed = 0
+        self.errors = []
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self._relative = (
+            os.open in os.supports_dir_fd
+            and os.unlink in os.supports_dir_fd
+            and os.rmdir in os.supports_dir_fd
+            and os.scandir in os.supports_fd
+        )
+        if len(self.paths) == 1:
+            descr = "Deleting " + self.paths[0]
+        else:
+            descr = "Deleting %d files" % len(self.paths)
+        Loadable.__init__(self, self.generate(), descr)
+
+    def destroy(self):
+        self._cancelled.set()
+
+    def _count(self, number=1):
+        with self._lock:
+            self.removed += number
+
+    def _error(self, err):
+        with self._lock:
+            self.errors.append(err)
+
+    def _rmtree(self, path):
+        if not self._relative:
+            import shutil
+
+            shutil.rmtree(path, onerror=lambda _, __, exc: self._error(exc[1]))
+            self._count()
+            return
+        parent = os.open(os.path.dirname(path), os.O_RDONLY)
+        try:
+            self._rmtree_at(parent, os.path.basename(path))
+        finally:
+            os.close(parent)
+
+    def _rmtree_at(self, dir_fd, name):
+        flags = os.O_RDONLY | getattr(os, "O_DIRECTORY", 0)
+        flags |= getattr(os, "O_NOFOLLOW", 0)
+        try:
+            fd = os.open(name, flags, dir_fd=dir_fd)
+        except OSError as err:
+            self._error(err)
+            return
+        try:
+            for entry in os.scandir(fd):
+                if self._cancelled.is_set():
+                    return
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        self._rmtree_at(fd, entry.name)
+                    else:
+                        os.unlink(entry.name, dir_fd=fd)
+                        self._count()
+                except OSError as err:
+                    self._error(err)
+        finally:
+            os.close(fd)
+        try:
+            os.rmdir(name, dir_fd=dir_fd)
+            self._count()
+        except OSError as err:
+            self._error(err)
+
+    def _remove(self, path):
+        if self._cancelled.is_set():
+            return
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                self._rmtree(path)
+            else:
+                os.unlink(path)
+                self._count()
+        except OSError as err:
+            self._error(err)
+
+    def generate(self):
+        from concurrent.futures import ThreadPoolExecutor, wait
+
+        # Split the top level directories into their entries, so that even
+        # a single big tree keeps all workers busy.  The directories
+        # themselves are removed when their contents are gone.
+        pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = []
+        toplevel_dirs = []
+        try:
+            for path in self.paths:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    toplevel_dirs.append(path)
+                    try:
+                        for entry in os.scandir(path):
+                            futures.append(pool.submit(self._remove, entry.path))
+                            if len(futures) % 1000 == 0:
+                                yield
+                    except OSError as err:
+                        self._error(err)
+                else:
+                    futures.append(pool.submit(self._remove, path))
+
+            pending = futures
+            while pending:
+                if self._cancelled.is_set():
+                    return
+                pending = wait(pending, timeout=0.01)[1]
+                self.percent = 100 * (len(futures) - len(pending)) // len(futures)
+                self.description = "Deleting: %d removed" % self.removed
+                yield
+            for path in reversed(toplevel_dirs):
+                self._remove(path)
+        finally:
+            self._cancelled.set()
+            pool.shutdown(wait=False)
+            if self.errors:
+                self.fm.notify(
+                    "Deletion: %d errors, first: %s"
+                    % (len(self.errors), self.errors[0]),
+                    bad=True,
+                )
+            self.fm.thistab.ensure_correct_pointer()
+
+
+class Selection(object):
+    """The files a command acts on
+
+    These are the paths given as arguments, or else the marked files, or
+    else the current file.  The count, total size and the summary for the
+    confirmation prompt are computed once and cached; the summary only
+    names the first few files, however many there are.
+    """
+
+    summary_length = 5
+
+    def __init__(self, paths, names=None, fobjs=None, marked=False):
+        self.paths = paths
+        self._names = names
+        self._fobjs = fobjs
+        self._marked = marked
+        self._size = None
+
+    @classmethod
+    def resolve(cls, fm, args):
+        """The selection for a command with the (shell-escaped) arguments"""
+        import shlex
+
+        if args:
+            names = shlex.split(args)
+            return cls([os.path.abspath(name) for name in names], names)
+        # Same as thistab.get_selection(), minus the garbage collection of
+        # marked_items, which is quadratic in the number of marked files.
+        thisdir = fm.thisdir
+        fobjs = []
+        if thisdir and thisdir.files and thisdir.marked_items:
+            fobjs = [fobj for fobj in thisdir.files if fobj.marked]
+        # marked_items may only hold files that are gone by now
+        marked = bool(fobjs)
+        if not marked:
+            fobjs = fm.thistab.get_selection()
+        return cls([fobj.path for fobj in fobjs], fobjs=fobjs, marked=marked)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __bool__(self):
+        return bool(self.paths)
+
+    __nonzero__ = __bool__
+
+    def is_many(self):
+        """Are these marked files, several files or a non-empty directory?"""
+        return self._marked or len(self.paths) > 1 or (
+            bool(self.paths) and is_directory_with_files(self.paths[0])
+        )
+
+    def name(self, i):
+        if self._fobjs is not None:
+            # relative_path used for a user-friendly output
+            return self._fobjs[i].relative_path
+        return self._names[i]
+
+    @property
+    def size(self):
+        """The total size of the selected files, not counting the contents
+        of directories"""
+        if self._size is None:
+            size = 0
+            if self._fobjs is not None:
+                for fobj in self._fobjs:
+                    if fobj.stat and not fobj.is_directory:
+                        size += fobj.stat.st_size
+            else:
+                for path in self.paths:
+                    try:
+                        stat = os.lstat(path)
+                    except OSError:
+                        continue
+                    if not os.path.isdir(path) or os.path.islink(path):
+                        size += stat.st_size
+            self._size = size
+        return self._size
+
+    def summary(self):
+        from ranger.ext.human_readable import human_readable
+
+        count = len(self.paths)
+        shown = min(count, self.summary_length)
+        text = ", ".join(self.name(i) for i in range(shown))
+        if count > shown:
+            text += " and %d more (%d files, %s)" % (
+                count - shown,
+                count,
+                human_readable(self.size),
+            )
+        return text
+
+
 class delete(Command):
     """:delete
 
@@ -624,50 +1609,52 @@ class delete(Command):
     escape_macros_for_shell = True
 
     def execute(self):
-        import shlex
         from functools import partial
 
-        def is_directory_with_files(path):
-            return (
-                os.path.isdir(path)
-                and not os.path.islink(path)
-                and len(os.listdir(path)) > 0
-            )
-
-        if self.rest(1):
-            files = shlex.split(self.rest(1))
-            many_files = len(files) > 1 or is_directory_with_files(files[0])
-        else:
-            cwd = self.fm.thisdir
-            tfile = self.fm.thisfile
-            if not cwd or not tfile:
-                self.fm.notify("Error: no file selected for deletion!", bad=True)
-                return
-
-            # relative_path used for a user-friendly output in the confirmation.
-            files = [f.relative_path for f in self.fm.thistab.get_selection()]
-            many_files = cwd.marked_items or is_directory_with_files(tfile.path)
+        if not self.rest(1) and (not self.fm.thisdir or not self.fm.thisfile):
+            self.fm.notify("Error: no file selected for deletion!", bad=True)
+            return
+        selection = Selection.resolve(self.fm, self.rest(1))
+        if not selection:
+            return
 
         confirm = self.fm.settings.confirm_on_delete
-        if confirm != "never" and (confirm != "multiple" or many_files):
+        if confirm != "never" and (confirm != "multiple" or selection.is_many()):
             self.fm.ui.console.ask(
-                "Confirm deletion of: %s (y/N)" % ", ".join(files),
-                partial(self._question_callback, files),
+                "Confirm deletion of: %s (y/N)" % selection.summary(),
+                partial(self._question_callback, selection.paths),
                 ("n", "N", "y", "Y"),
             )
         else:
             # no need for a confirmation, just delete
-            self.fm.delete(files)
+            self._remove(selection.paths)
 
     def tab(self, tabnum):
         return self._tab_directory_content()
 
-    def _question_callback(self, files, answer):
+    def _question_callback(self, paths, answer):
         if answer == "y" or answer == "Y":
-            self.fm.delete(files)
+            self._remove(paths)
+
+    def _remove(self, paths):
+        """Untag the files and delete them in the background"""
+        removed = set(paths)
+        tags = self.fm.tags
+        if tags:
+            tags.sync()
+            prefixes = tuple(path.rstrip(os.sep) + os.sep for path in paths)
+            untagged = [
+                tag for tag in tags.tags if tag in removed or tag.startswith(prefixes)
+            ]
+            if untagged:
+                tags.remove(*untagged)
+        self.fm.copy_buffer = set(
+            fobj for fobj in self.fm.copy_buffer if fobj.path not in removed
+        )
+        self.fm.loader.add(DeleteLoader(paths))
 
 
-class trash(Command):
+class trash(delete):
     """:trash
 
     Tries to move the selection or the files passed in arguments (if any) to
@@ -682,51 +1669,75 @@ class trash(Command):
     marked files, it will require a confirmation.
     """
 
-    allow_abbrev = False
-    escape_macros_for_shell = True
+    batch_size = 1000
 
-    def execute(self):
-        import shlex
-        from functools import partial
+    def _remove(self, paths):
+        """Run the rifle "trash" rule in the background, in batches of files
+        so that huge selections don't exceed the argument length limit"""
+        from ranger.core.loader import CommandLoader
 
-        def is_directory_with_files(path):
-            return (
-                os.path.isdir(path)
-                and not os.path.islink(path)
-                and len(os.listdir(path)) > 0
+        rifle = self.fm.rifle
+        for _, command, label, _ in rifle.list_commands(paths):
+            if label == "trash":
+                break
+        else:
+            # No rule to batch: leave it to ranger, which reports that
+            self.fm.execute_file(paths, label="trash")
+            return
+        for i in range(0, len(paths), self.batch_size):
+            batch = paths[i : i + self.batch_size]
+            # pylint: disable=protected-access
+            script = rifle._build_command(batch, command, "")
+            descr = "Trashing %d files" % len(batch)
+            self.fm.loader.add(
+                CommandLoader(["/bin/sh", "-c", script], descr), append=True
             )
 
-        if self.rest(1):
-            files = shlex.split(self.rest(1))
-            many_files = len(files) > 1 or is_directory_with_files(files[0])
-        else:
-            cwd = self.fm.thisdir
-            tfile = self.fm.thisfile
-            if not cwd or not tfile:
-                self.fm.notify("Error: no file selected for deletion!", bad=True)
-                return
 
-            # relative_path used for a user-friendly output in the confirmation.
-            files = [f.relative_path for f in self.fm.thistab.get_selection()]
-            many_files = cwd.marked_items or is_directory_with_files(tfile.path)
+class InodeTypeIndex(object):
+    """Positions of the directories, files and links in a file list
 
-        confirm = self.fm.settings.confirm_on_delete
-        if confirm != "never" and (confirm != "multiple" or many_files):
-            self.fm.ui.console.ask(
-                "Confirm deletion of: %s (y/N)" % ", ".join(files),
-                partial(self._question_callback, files),
-                ("n", "N", "y", "Y"),
-            )
-        else:
-            # no need for a confirmation, just delete
-            self.fm.execute_file(files, label="trash")
+    The positions are sorted lists per type ("d", "f" and "l", like
+    filter_inode_type takes them), built in one pass the first time a
+    list is asked about and reused as long as it is the same list.
+    """
 
-    def tab(self, tabnum):
-        return self._tab_directory_content()
+    def __init__(self):
+        self._files = None
+        self._length = 0
+        self.positions = {}
 
-    def _question_callback(self, files, answer):
-        if answer == "y" or answer == "Y":
-            self.fm.execute_file(files, label="trash")
+    def update(self, files):
+        if self._files is files and self._length == len(files):
+            return
+        positions = {"d": [], "f": [], "l": []}
+        dirs, regular, links = positions["d"], positions["f"], positions["l"]
+        for i, fobj in enumerate(files):
+            if fobj.is_directory:
+                dirs.append(i)
+            elif fobj.is_file and not fobj.is_link:
+                regular.append(i)
+            if fobj.is_link:
+                links.append(i)
+        self._files = files
+        self._length = len(files)
+        self.positions = positions
+
+    def select(self, files, types):
+        """The sorted positions of the entries of any of the given types"""
+        self.update(files)
+        lists = [self.positions[t] for t in "dfl" if t in types]
+        if len(lists) == 1:
+            return lists[0]
+        return sorted(set().union(*lists))
+
+    def non_directories(self, files):
+        """The sorted positions of the entries that are not directories"""
+        self.update(files)
+        if "n" not in self.positions:
+            dirs = set(self.positions["d"])
+            self.positions["n"] = [i for i in range(len(files)) if i not in dirs]
+        return self.positions["n"]
 
 
 class jump_non(Command):
@@ -739,6 +1750,8 @@ class jump_non(Command):
      -w    Wrap around if reaching end of filelist
     """
 
+    index = InodeTypeIndex()
+
     def __init__(self, *args, **kwargs):
         super(jump_non, self).__init__(*args, **kwargs)
 
@@ -746,33 +1759,129 @@ class jump_non(Command):
         self._flag_reverse = "r" in flags
         self._flag_wrap = "w" in flags
 
-    @staticmethod
-    def _non(fobj, is_directory):
-        return fobj.is_directory if not is_directory else not fobj.is_directory
-
     def execute(self):
+        from bisect import bisect_left, bisect_right
+
         tfile = self.fm.thisfile
-        passed = False
-        found_before = None
-        found_after = None
-        for fobj in (
-            self.fm.thisdir.files[::-1] if self._flag_reverse else self.fm.thisdir.files
-        ):
-            if fobj.path == tfile.path:
-                passed = True
-                continue
+        files = self.fm.thisdir.files
+        if not tfile or not files:
+            return
+        current = self.fm.thisdir.pointer
+        if not 0 <= current < len(files) or files[current] is not tfile:
+            try:
+                current = files.index(tfile)
+            except ValueError:
+                return
 
-            if passed:
-                if self._non(fobj, tfile.is_directory):
-                    found_after = fobj.path
-                    break
-            elif not found_before and self._non(fobj, tfile.is_directory):
-                found_before = fobj.path
+        if tfile.is_directory:
+            positions = self.index.non_directories(files)
+        else:
+            positions = self.index.select(files, "d")
+        if not positions:
+            return
+        if self._flag_reverse:
+            i = bisect_left(positions, current) - 1
+            if i < 0:
+                if not self._flag_wrap:
+                    return
+                i = len(positions) - 1
+        else:
+            i = bisect_right(positions, current)
+            if i == len(positions):
+                if not self._flag_wrap:
+                    return
+                i = 0
+        self.fm.move(to=positions[i], one_indexed=False)
+
+
+def mark_items(directory, items, val):
+    """Mark or unmark many items of a directory in one pass
+
+    Directory.mark_item() searches the file list and the list of marked
+    items for every single item, this does the same bookkeeping once with
+    sets of object ids.
+    """
+    val = bool(val)
+    for item in items:
+        item.mark_set(val)
+    if val:
+        visible = set(map(id, directory.files))
+        seen = set(map(id, directory.marked_items))
+        for item in items:
+            if id(item) in visible and id(item) not in seen:
+                seen.add(id(item))
+                directory.marked_items.append(item)
+    else:
+        removed = set(map(id, items))
+        directory.marked_items[:] = [
+            item for item in directory.marked_items if id(item) not in removed
+        ]
+
+
+class TagIndex(object):
+    """Reverse index of fm.tags, mapping each tag to the tagged paths
+
+    Tags.sync() replaces the tags dict on every change made through the
+    Tags methods, so the index is only rebuilt when the dict (or its size)
+    changed.
+    """
+
+    def __init__(self):
+        self._tags = None
+        self._size = None
+        self.paths = {}
+
+    def update(self, tags):
+        if tags.tags is self._tags and len(tags.tags) == self._size:
+            return
+        paths = {}
+        for path, tag in tags.tags.items():
+            paths.setdefault(tag, set()).add(path)
+        self.paths = paths
+        self._tags = tags.tags
+        self._size = len(tags.tags)
+
+    def lookup(self, tags=""):
+        """Return the paths tagged with any of the given tags, or with any
+        tag at all if tags is empty"""
+        if not tags:
+            tags = self.paths.keys()
+        result = set()
+        for tag in set(tags):
+            result.update(self.paths.get(tag, ()))
+        return result
+
+
+class RealpathIndex(object):
+    """Files of a directory listing grouped by their realpath
+
+    The realpaths of symlinks are resolved with a thread pool, once per
+    directory load, since each one may need several round trips to a slow
+    filesystem.
+    """
+
+    max_workers = 8
+
+    def __init__(self):
+        self.files_all = None
+        self.files = {}
 
-        if found_after:
-            self.fm.select_file(found_after)
-        elif self._flag_wrap and found_before:
-            self.fm.select_file(found_before)
+    def get(self, directory):
+        if directory.files_all is self.files_all:
+            return self.files
+        links = [fobj for fobj in directory.files_all if fobj.is_link]
+        if len(links) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                for _ in pool.map(lambda fobj: fobj.realpath, links):
+                    pass
+        files = {}
+        for fobj in directory.files_all:
+            files.setdefault(fobj.realpath, []).append(fobj)
+        self.files = files
+        self.files_all = directory.files_all
+        return files
 
 
 class mark_tag(Command):
@@ -783,19 +1892,27 @@ class mark_tag(Command):
     """
 
     do_mark = True
+    tag_index = TagIndex()
+    realpath_index = RealpathIndex()
 
     def execute(self):
         cwd = self.fm.thisdir
         tags = self.rest(1).replace(" ", "")
         if not self.fm.tags or not cwd.files:
             return
-        for fileobj in cwd.files:
-            try:
-                tag = self.fm.tags.tags[fileobj.realpath]
-            except KeyError:
-                continue
-            if not tags or tag in tags:
-                cwd.mark_item(fileobj, val=self.do_mark)
+        self.tag_index.update(self.fm.tags)
+        tagged = self.tag_index.lookup(tags)
+        by_realpath = self.realpath_index.get(cwd)
+        if len(tagged) > len(by_realpath):
+            tagged = tagged.intersection(by_realpath)
+        visible = set(map(id, cwd.files))
+        items = [
+            fileobj
+            for path in tagged
+            for fileobj in by_realpath.get(path, ())
+            if id(fileobj) in visible
+        ]
+        mark_items(cwd, items, self.do_mark)
         self.fm.ui.status.need_redraw = True
         self.fm.ui.need_redraw = True
 
@@ -818,59 +1935,606 @@ class console(Command):
         self.fm.open_console(self.rest(1), position=position)
 
 
-class load_copy_buffer(Command):
-    """:load_copy_buffer
+def read_copy_buffer(fname, chunk_size=1 << 16):
+    """Yield the paths stored in a copy buffer file, one chunk at a time
 
-    Load the copy buffer from datadir/copy_buffer
+    Handles gzip compressed files, and the old format with one path per
+    line as well as NUL separated paths.  Raises OSError if the file can't
+    be read.
+    """
+    import gzip
+
+    with open(fname, "rb") as raw:
+        stream = gzip.GzipFile(fileobj=raw) if raw.read(2) == b"\x1f\x8b" else raw
+        raw.seek(0)
+        # Paths can't contain NUL, so a file with a NUL byte anywhere can't
+        # be in the old format.  Until one shows up, the chunks are kept.
+        undecided = []
+        rest = b""
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            if undecided is not None:
+                undecided.append(chunk)
+                if b"\0" not in chunk:
+                    continue
+                chunk = b"".join(undecided)
+                undecided = None
+            records = (rest + chunk).split(b"\0")
+            rest = records.pop()
+            yield [os.fsdecode(record) for record in records if record]
+        if undecided:
+            records = b"".join(undecided).split(b"\n")
+            yield [os.fsdecode(record) for record in records if record]
+        elif rest:
+            yield [os.fsdecode(rest)]
+
+
+def write_copy_buffer(fname, paths, compress=False):
+    """Write paths to a copy buffer file, NUL separated
+
+    The file is written to a temporary name and renamed, so an interrupted
+    save never leaves a truncated copy buffer behind.
     """
+    import gzip
 
-    copy_buffer_filename = "copy_buffer"
+    tmpname = fname + ".tmp"
+    with open(tmpname, "wb") as raw:
+        stream = raw
+        if compress:
+            stream = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=1)
+        try:
+            write = stream.write
+            for path in paths:
+                write(os.fsencode(path))
+                write(b"\0")
+        finally:
+            if compress:
+                stream.close()
+    os.rename(tmpname, fname)
 
-    def execute(self):
-        import sys
-        from ranger.container.file import File
-        from os.path import exists
 
-        fname = self.fm.datapath(self.copy_buffer_filename)
-        unreadable = IOError if sys.version_info[0] < 3 else OSError
-        try:
-            fobj = open(fname, "r")
-        except unreadable:
+class CopyBufferLoader(Loadable, FileManagerAware):
+    """Loads the copy buffer from a file in the background
+
+    The paths are read in chunks, their existence is checked on a thread
+    pool a chunk at a time and File objects are only built for the paths
+    that still exist.
+    """
+
+    progressbar_supported = True
+    max_workers = 8
+    batch_size = 256
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.count = 0
+        Loadable.__init__(self, self.generate(), "Loading copy buffer")
+
+    @staticmethod
+    def _existing(paths):
+        exists = os.path.exists
+        return [path for path in paths if exists(path)]
+
+    def generate(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from ranger.container.file import File
+
+        try:
+            total = max(os.path.getsize(self.fname), 1)
+        except OSError:
+            total = 1
+        copy_buffer = set()
+        read = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            try:
+                for paths in read_copy_buffer(self.fname):
+                    batches = [
+                        paths[i : i + self.batch_size]
+                        for i in range(0, len(paths), self.batch_size)
+                    ]
+                    for batch in pool.map(self._existing, batches):
+                        copy_buffer.update(
+                            File(path, path_is_abs=True) for path in batch
+                        )
+                    read += sum(len(path) + 1 for path in paths)
+                    self.percent = min(99, 100 * read // total)
+                    yield
+            except (OSError, IOError, EOFError) as err:
+                self.fm.notify("Cannot read %s: %s" % (self.fname, err), bad=True)
+                return
+        self.count = len(copy_buffer)
+        self.fm.copy_buffer = copy_buffer
+        self.fm.ui.redraw_main_column()
+
+
+class load_copy_buffer(Command):
+    """:load_copy_buffer
+
+    Load the copy buffer from datadir/copy_buffer
+    """
+
+    copy_buffer_filename = "copy_buffer"
+
+    def execute(self):
+        fname = self.fm.datapath(self.copy_buffer_filename)
+        if not fname or not os.access(fname, os.R_OK):
             return self.fm.notify(
                 "Cannot open %s" % (fname or self.copy_buffer_filename), bad=True
             )
-
-        self.fm.copy_buffer = set(File(g) for g in fobj.read().split("\n") if exists(g))
-        fobj.close()
-        self.fm.ui.redraw_main_column()
+        self.fm.loader.add(CopyBufferLoader(fname))
         return None
 
 
 class save_copy_buffer(Command):
-    """:save_copy_buffer
+    """:save_copy_buffer [-z]
 
     Save the copy buffer to datadir/copy_buffer
+
+    The paths are stored NUL separated, and gzip compressed with -z.
     """
 
     copy_buffer_filename = "copy_buffer"
+    compress = False
 
     def execute(self):
         import sys
 
-        fname = None
+        flags, _ = self.parse_flags()
         fname = self.fm.datapath(self.copy_buffer_filename)
         unwritable = IOError if sys.version_info[0] < 3 else OSError
         try:
-            fobj = open(fname, "w")
+            if not fname:
+                raise unwritable()
+            write_copy_buffer(
+                fname,
+                (fobj.path for fobj in self.fm.copy_buffer),
+                compress=self.compress or "z" in flags,
+            )
         except unwritable:
             return self.fm.notify(
                 "Cannot open %s" % (fname or self.copy_buffer_filename), bad=True
             )
-        fobj.write("\n".join(fobj.path for fobj in self.fm.copy_buffer))
-        fobj.close()
         return None
 
 
+class MainLoopCalls(object):
+    """Runs functions that other threads hand over, on ranger's main loop
+
+    ranger has no signal for a turn of its main loop, so install() wraps
+    fm.ui.redraw, which the loop calls on every turn (at the latest every
+    idle_delay milliseconds), to first run what is waiting in a
+    queue.Queue.  call() may be used from any thread, install() only from
+    the main thread.
+    """
+
+    calls = None
+    ui = None
+
+    @classmethod
+    def install(cls, fm):
+        import queue
+
+        if cls.calls is None:
+            cls.calls = queue.Queue()
+        if cls.ui is fm.ui:
+            return
+        cls.ui = fm.ui
+        redraw = fm.ui.redraw
+
+        def run_calls_and_redraw():
+            cls.run_pending()
+            redraw()
+
+        fm.ui.redraw = run_calls_and_redraw
+
+    @classmethod
+    def call(cls, function, *args):
+        cls.calls.put((function, args))
+
+    @classmethod
+    def run_pending(cls):
+        import queue
+
+        while True:
+            try:
+                function, args = cls.calls.get_nowait()
+            except queue.Empty:
+                return
+            function(*args)
+
+
+def split_records(data):
+    """Split NUL terminated records off data, return them and the rest"""
+    records = data.split(b"\0")
+    return records[:-1], records[-1]
+
+
+def join_records(records):
+    """Join records, terminating each with NUL"""
+    return b"".join(record + b"\0" for record in records)
+
+
+class CopyBufferServer(object):
+    """Relays copy buffer changes between the connected ranger instances
+
+    The server keeps the shared set of paths and the shared cut flag.
+    Clients send records of the form "+path" or "-path", and "c1" or "c0"
+    for fm.do_cut, each terminated by NUL; the server applies them and
+    forwards the paths to every other client.  Cut records are sent back
+    to their sender as well, so that all clients end up with the flag the
+    server saw last.  New clients first receive the whole state.  The
+    client sockets are non-blocking with an output buffer each, so a
+    client that is busy sending can't stall the server.
+    """
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.paths = set()
+        self.cut = None
+        self.inbuf = {}
+        self.outbuf = {}
+
+    def serve(self, stop):
+        import select
+
+        while not stop.is_set():
+            socks = [self.listener] + list(self.inbuf)
+            pending = [sock for sock, data in self.outbuf.items() if data]
+            readable, writable = select.select(socks, pending, [], 0.5)[:2]
+            for sock in writable:
+                self._flush(sock)
+            for sock in readable:
+                if sock is self.listener:
+                    self._accept()
+                elif sock in self.inbuf:
+                    self._receive(sock)
+        self.listener.close()
+        for sock in list(self.inbuf):
+            sock.close()
+
+    def _accept(self):
+        try:
+            sock = self.listener.accept()[0]
+        except OSError:
+            return
+        sock.setblocking(False)
+        self.inbuf[sock] = b""
+        self.outbuf[sock] = bytearray()
+        for path in self.paths:
+            self.outbuf[sock] += b"+" + os.fsencode(path) + b"\0"
+        if self.cut is not None:
+            self.outbuf[sock] += b"c" + self.cut + b"\0"
+
+    def _drop(self, sock):
+        del self.inbuf[sock]
+        del self.outbuf[sock]
+        sock.close()
+
+    def _flush(self, sock):
+        data = self.outbuf[sock]
+        try:
+            sent = sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._drop(sock)
+            return
+        del data[:sent]
+
+    def _receive(self, sock):
+        try:
+            data = sock.recv(1 << 16)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._drop(sock)
+            return
+        records, self.inbuf[sock] = split_records(self.inbuf[sock] + data)
+        changes = []
+        cuts = []
+        for record in records:
+            kind = record[:1]
+            if kind == b"c":
+                self.cut = record[1:]
+                cuts.append(record)
+                continue
+            path = os.fsdecode(record[1:])
+            if kind == b"+":
+                self.paths.add(path)
+            else:
+                self.paths.discard(path)
+            changes.append(record)
+        changes = join_records(changes)
+        cuts = join_records(cuts)
+        for other, data in self.outbuf.items():
+            if other is not sock:
+                data += changes
+            data += cuts
+
+
+class CopyBufferUpdate(Loadable, FileManagerAware):
+    """Applies what a CopyBufferService received, on the main loop
+
+    The new copy buffer is built from the one read at the start and only
+    swapped in if that is still the current one.  Otherwise, e.g. after a
+    yank in between, the changes are applied again on top of the newer
+    buffer; the service then sends the yanked paths to the other
+    instances.  Cancelling drops the pending changes, so the local buffer
+    wins and is sent to the others instead.
+    """
+
+    batch_size = 1024
+
+    def __init__(self, service):
+        self.service = service
+        Loadable.__init__(self, self.generate(), "Updating copy buffer")
+
+    def generate(self):
+        service = self.service
+        while True:
+            with service.lock:
+                records, service.incoming = service.incoming, []
+                messages, service.messages = service.messages, []
+                if not records and not messages:
+                    service.update = None
+                    service.pending = False
+                    return
+            for message in messages:
+                self.fm.notify(message, bad=True)
+            if records:
+                for _ in self._apply(records):
+                    yield
+
+    def _apply(self, records):
+        from ranger.container.file import File
+
+        while True:
+            buf = self.fm.copy_buffer
+            snapshot = set(buf)
+            do_cut = self.fm.do_cut
+            current = dict((fobj.path, fobj) for fobj in buf)
+            cut = do_cut
+            for i, record in enumerate(records, 1):
+                kind = record[:1]
+                if kind == b"c":
+                    cut = record[1:] == b"1"
+                    continue
+                path = os.fsdecode(record[1:])
+                if kind == b"+":
+                    if path not in current:
+                        current[path] = File(path, path_is_abs=True)
+                else:
+                    current.pop(path, None)
+                if i % self.batch_size == 0:
+                    yield
+            if (
+                self.fm.copy_buffer is buf
+                and buf == snapshot
+                and self.fm.do_cut == do_cut
+            ):
+                break
+        self.fm.copy_buffer = set(current.values())
+        self.fm.do_cut = cut
+        self.fm.ui.redraw_main_column()
+
+    def destroy(self):
+        service = self.service
+        with service.lock:
+            if service.update is self:
+                service.update = None
+                service.pending = False
+                service.incoming = []
+
+
+class CopyBufferService(FileManagerAware):
+    """Keeps fm.copy_buffer and fm.do_cut in sync with other ranger instances
+
+    A thread connects to the unix socket at sockname, starting a
+    CopyBufferServer there first if no other instance serves it (a lock
+    file next to the socket decides which one does).  It sends the changes
+    of the local copy buffer as deltas.  The deltas it receives are passed
+    to the main loop through MainLoopCalls, which queues a
+    CopyBufferUpdate there like any other background task, so the thread
+    never changes the file manager or the loader itself.  When the serving
+    instance exits, another one takes over.
+
+    ranger has no hook for changes of the copy buffer, so it is compared
+    with the last known state whenever the set object or its size changes,
+    and fully every full_sync_interval seconds.  While received changes
+    wait to be applied, nothing is compared.
+    """
+
+    poll_interval = 0.2
+    full_sync_interval = 5
+    max_retry_interval = 5
+
+    def __init__(self, sockname):
+        import threading
+
+        self.sockname = sockname
+        self.known = set()
+        self.known_cut = None
+        self.lock = threading.Lock()
+        self.incoming = []
+        self.messages = []
+        self.pending = False
+        self.update = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="copy buffer")
+        self._thread.daemon = True
+        self._lockfile = None
+
+    def start(self):
+        MainLoopCalls.install(self.fm)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _post(self, records=(), messages=()):
+        """Hand received records and messages over to the main loop"""
+        with self.lock:
+            self.incoming.extend(records)
+            self.messages.extend(messages)
+            if not self.pending:
+                self.pending = True
+                MainLoopCalls.call(self._schedule)
+
+    def _schedule(self):
+        """Queue a CopyBufferUpdate, on the main loop"""
+        self.update = CopyBufferUpdate(self)
+        self.fm.loader.add(self.update)
+
+    def _run(self):
+        import socket
+
+        delay = self.poll_interval
+        while not self._stop.is_set():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.sockname)
+            except OSError:
+                sock.close()
+                # Back off even if a server was just started here, an
+                # unusable socket must not be retried in a busy loop.
+                self._serve()
+                self._stop.wait(delay)
+                delay = min(2 * delay, self.max_retry_interval)
+                continue
+            delay = self.poll_interval
+            try:
+                self._sync(sock)
+            except OSError:
+                pass
+            finally:
+                sock.close()
+        if self._lockfile is not None:
+            self._lockfile.close()
+
+    def _serve(self):
+        """Start a server thread if nobody else serves the socket"""
+        import fcntl
+        import socket
+        import threading
+
+        if self._lockfile is not None:
+            return True
+        lockfile = open(self.sockname + ".lock", "a")
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (OSError, IOError):
+            lockfile.close()
+            return False
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            if os.path.exists(self.sockname):
+                os.unlink(self.sockname)
+            listener.bind(self.sockname)
+            listener.listen(16)
+        except OSError as err:
+            listener.close()
+            lockfile.close()
+            self._post(messages=["Cannot share the copy buffer: %s" % err])
+            self._stop.set()
+            return False
+        self._lockfile = lockfile
+        thread = threading.Thread(
+            target=CopyBufferServer(listener).serve, args=(self._stop,)
+        )
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _sync(self, sock):
+        import select
+        import time
+
+        # The local copy buffer is merged into the shared one, so
+        # everything in it counts as a change at first.
+        self.known = set()
+        self.known_cut = None
+        signature = None
+        last_full_sync = 0
+        rest = b""
+        while not self._stop.is_set():
+            # Changes that wait to be applied aren't in the local buffer
+            # yet, comparing now would send them back as removals.
+            if not self.pending:
+                buf = self.fm.copy_buffer
+                now = time.time()
+                message = []
+                if (id(buf), len(buf)) != signature or (
+                    now - last_full_sync > self.full_sync_interval
+                ):
+                    try:
+                        paths = set(fobj.path for fobj in list(buf))
+                    except RuntimeError:  # changed during iteration
+                        continue
+                    signature = (id(buf), len(buf))
+                    last_full_sync = now
+                    message.extend(
+                        b"+" + os.fsencode(path) for path in paths - self.known
+                    )
+                    message.extend(
+                        b"-" + os.fsencode(path) for path in self.known - paths
+                    )
+                    self.known = paths
+                cut = b"1" if self.fm.do_cut else b"0"
+                if cut != self.known_cut:
+                    message.append(b"c" + cut)
+                    self.known_cut = cut
+                if message:
+                    sock.sendall(join_records(message))
+            if select.select([sock], [], [], self.poll_interval)[0]:
+                data = sock.recv(1 << 16)
+                if not data:
+                    return
+                records, rest = split_records(rest + data)
+                if records:
+                    self._receive(records)
+
+    def _receive(self, records):
+        for record in records:
+            kind = record[:1]
+            if kind == b"c":
+                self.known_cut = record[1:]
+            elif kind == b"+":
+                self.known.add(os.fsdecode(record[1:]))
+            else:
+                self.known.discard(os.fsdecode(record[1:]))
+        self._post(records)
+
+
+class share_copy_buffer(Command):
+    """:share_copy_buffer [off]
+
+    Share the copy buffer with all other ranger instances that run this
+    command, through a unix socket in the data directory.  Copying or
+    cutting files in one of them shows up in the others right away.
+    """
+
+    socket_filename = "copy_buffer.sock"
+    service = None
+
+    def execute(self):
+        cls = type(self)
+        if cls.service is not None:
+            cls.service.stop()
+            cls.service = None
+        if self.arg(1) == "off":
+            return
+        sockname = self.fm.datapath(self.socket_filename)
+        if not sockname:
+            self.fm.notify("Cannot share the copy buffer without a data directory")
+            return
+        cls.service = CopyBufferService(sockname)
+        cls.service.start()
+
+
 class unmark_tag(mark_tag):
     """:unmark_tag [<tags>]
 
@@ -1059,10 +2723,170 @@ class rename_append(Command):
         self.fm.open_console("rename " + relpath, position=(7 + pos))
 
 
+def parse_chmod_mode(spec):
+    """Parse an octal or symbolic (u+x,go-w,a=rX) mode like chmod(1)
+
+    Returns a function that takes the current permission bits and whether
+    the file is a directory, and returns the new permission bits.  Raises
+    ValueError for invalid modes.
+    """
+    if re.match(r"^[0-7]{1,4}$", spec):
+        mode = int(spec, 8)
+        return lambda current, is_dir: mode
+
+    who_bits = {"u": 0o4700, "g": 0o2070, "o": 0o1007, "a": 0o7777}
+    umask = os.umask(0)
+    os.umask(umask)
+    clauses = []
+    for clause in spec.split(","):
+        match = re.match(r"^([ugoa]*)((?:[-+=][rwxXst]*)+)$", clause)
+        if not match:
+            raise ValueError(spec)
+        who = 0
+        for char in match.group(1) or "a":
+            who |= who_bits[char]
+        # Without "who", the bits set in the umask are left alone
+        mask = who if match.group(1) else who & ~umask
+        for operator, perms in re.findall(r"([-+=])([rwxXst]*)", match.group(2)):
+            clauses.append((who, mask, operator, perms))
+
+    perm_bits = {"r": 0o444, "w": 0o222, "x": 0o111, "s": 0o6000, "t": 0o1000}
+
+    def change(current, is_dir):
+        mode = current
+        for who, mask, operator, perms in clauses:
+            bits = 0
+            for char in perms:
+                if char == "X":
+                    # Like chmod(1), against the mode the earlier clauses made
+                    if is_dir or mode & 0o111:
+                        bits |= 0o111
+                else:
+                    bits |= perm_bits[char]
+            bits &= mask
+            if operator == "+":
+                mode |= bits
+            elif operator == "-":
+                mode &= ~bits
+            else:
+                mode = (mode & ~who) | bits
+        return mode
+
+    return change
+
+
+def chmod_if_needed(path, st_mode, change):
+    """Apply change to path unless its mode is already right
+
+    st_mode is the mode of the file as it was last stat()ed.  Returns
+    whether the mode was changed.
+    """
+    import stat
+
+    current = stat.S_IMODE(st_mode)
+    mode = change(current, stat.S_ISDIR(st_mode))
+    if mode == current:
+        return False
+    os.chmod(path, mode)
+    return True
+
+
+class ChmodLoader(Loadable, FileManagerAware):
+    """Changes permissions of whole trees in the background
+
+    The directories are read with scandir on a thread pool, one task per
+    directory, and the stat data that scandir returns decides whether a
+    file needs a chmod at all.  Symlinks inside the trees are not
+    followed.  Like chmod -R, a directory is changed before its contents
+    are read.  Afterwards only the changed files that ranger has loaded are
+    refreshed.
+    """
+
+    max_workers = 8
+
+    def __init__(self, fobjs, change):
+        self.fobjs = fobjs
+        self.change = change
+        self.changed = []
+        self.errors = []
+        descr = "chmod -R on %d files" % len(fobjs)
+        Loadable.__init__(self, self.generate(), descr)
+
+    def _walk(self, path):
+        """Change the entries of a directory, return its subdirectories"""
+        changed = []
+        errors = []
+        subdirs = []
+        try:
+            entries = list(os.scandir(path))
+        except OSError as err:
+            return changed, [err], subdirs
+        for entry in entries:
+            try:
+                if entry.is_symlink():
+                    continue
+                st_mode = entry.stat(follow_symlinks=False).st_mode
+                if chmod_if_needed(entry.path, st_mode, self.change):
+                    changed.append(entry.path)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+            except OSError as err:
+                errors.append(err)
+        return changed, errors, subdirs
+
+    def generate(self):
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for fobj in self.fobjs:
+                try:
+                    st_mode = (fobj.stat or os.stat(fobj.path)).st_mode
+                    if chmod_if_needed(fobj.path, st_mode, self.change):
+                        self.changed.append(fobj.path)
+                except OSError as err:
+                    self.errors.append(err)
+                if fobj.is_directory and not fobj.is_link:
+                    pending.add(pool.submit(self._walk, fobj.path))
+            while pending:
+                done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+                for future in done:
+                    changed, errors, subdirs = future.result()
+                    self.changed.extend(changed)
+                    self.errors.extend(errors)
+                    pending.update(pool.submit(self._walk, path) for path in subdirs)
+                self.description = "chmod -R: %d changed" % len(self.changed)
+                yield
+        refresh_paths(self.fm, self.changed)
+        if self.errors:
+            self.fm.notify(
+                "chmod: %d errors, first: %s" % (len(self.errors), self.errors[0]),
+                bad=True,
+            )
+
+
+def refresh_paths(fm, paths):
+    """Reload the stat data of just these files, if ranger has them loaded"""
+    by_dir = collections.defaultdict(set)
+    for path in paths:
+        by_dir[os.path.dirname(path)].add(path)
+    for dirpath, changed in by_dir.items():
+        directory = fm.directories.get(dirpath)
+        if directory is None or not directory.files_all:
+            continue
+        for fobj in directory.files_all:
+            if fobj.path in changed:
+                fobj.load()
+    if paths:
+        fm.ui.redraw_main_column()
+
+
 class chmod(Command):
-    """:chmod <octal number>
+    """:chmod [-R] <mode>
 
-    Sets the permissions of the selection to the octal number.
+    Sets the permissions of the selection to the mode, which is an octal
+    number or a symbolic mode like chmod(1) takes (u+x, go-w, a=rX, ...).
+    With -R, the contents of selected directories are changed too.
 
     The octal number is between 0 and 777. The digits specify the
     permissions for the user, the group and others.
@@ -1072,32 +2896,281 @@ class chmod(Command):
     """
 
     def execute(self):
-        mode_str = self.rest(1)
+        recursive = self.arg(1) == "-R"
+        mode_str = self.rest(2 if recursive else 1)
         if not mode_str:
             if self.quantifier is None:
                 self.fm.notify(
-                    "Syntax: chmod <octal number> " "or specify a quantifier", bad=True
+                    "Syntax: chmod [-R] <mode> " "or specify a quantifier", bad=True
                 )
                 return
             mode_str = str(self.quantifier)
 
         try:
-            mode = int(mode_str, 8)
-            if mode < 0 or mode > 0o777:
+            change = parse_chmod_mode(mode_str)
+            if mode_str.isdigit() and int(mode_str, 8) > 0o777:
                 raise ValueError
         except ValueError:
-            self.fm.notify("Need an octal number between 0 and 777!", bad=True)
+            self.fm.notify(
+                "Need an octal number between 0 and 777 or a symbolic mode!", bad=True
+            )
+            return
+
+        selection = self.fm.thistab.get_selection()
+        if recursive:
+            self.fm.loader.add(ChmodLoader(selection, change))
             return
 
-        for fobj in self.fm.thistab.get_selection():
+        changed = []
+        for fobj in selection:
             try:
-                os.chmod(fobj.path, mode)
+                # fobj.stat is None if ranger couldn't stat the file when
+                # it loaded the directory
+                st_mode = (fobj.stat or os.stat(fobj.path)).st_mode
+                if chmod_if_needed(fobj.path, st_mode, change):
+                    changed.append(fobj.path)
             except OSError as ex:
                 self.fm.notify(ex)
 
-        # reloading directory.  maybe its better to reload the selected
-        # files only.
-        self.fm.thisdir.content_outdated = True
+        # Reload the changed files only, not the whole directory
+        refresh_paths(self.fm, changed)
+
+
+class RenamePlan(object):
+    """A batch of renames, carried out in-process with os.rename
+
+    The moves are treated as simultaneous, like the file list that
+    bulkrename edits: chains (a->b, b->c) are ordered so that nothing is
+    overwritten, and cycles and swaps (a->b, b->a) go through a temporary
+    name.  Existing files that are not renamed away are never overwritten.
+    """
+
+    temp_suffix = ".ranger-rename"
+
+    def __init__(self, dirs, moves):
+        self.dirs = dirs
+        self.moves = moves
+
+    @classmethod
+    def from_script(cls, script, cwd):
+        """Parse a bulkrename script, None if it does anything else
+
+        Only comments and the "mkdir -vp -- dir" and "mv -vi -- old new"
+        lines that bulkrename generates are understood.  Scripts that rely
+        on the order of their moves (because a source only exists after
+        an earlier move), move a file twice, move two files to the same
+        name or use anything the shell would expand are left to the shell
+        too.
+        """
+        import shlex
+
+        dirs = []
+        moves = []
+        for line in script.splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if any(char in line for char in "~$`*?["):
+                return None
+            try:
+                words = shlex.split(line)
+            except ValueError:
+                return None
+            command, args = words[0], words[1:]
+            while args and args[0].startswith("-") and args[0] != "--":
+                if command == "mkdir" and args[0] not in ("-v", "-p", "-vp", "-pv"):
+                    return None
+                if command == "mv" and args[0] not in ("-v", "-i", "-vi", "-iv"):
+                    return None
+                args.pop(0)
+            if args and args[0] == "--":
+                args.pop(0)
+            if command == "mkdir" and args:
+                dirs.extend(os.path.join(cwd, arg) for arg in args)
+            elif command == "mv" and len(args) == 2:
+                moves.append(tuple(os.path.join(cwd, arg) for arg in args))
+            else:
+                return None
+        sources = [old for old, _ in moves]
+        targets = [new for _, new in moves]
+        if (
+            len(set(sources)) != len(sources)
+            or len(set(targets)) != len(targets)
+            or not all(os.path.lexists(old) for old in sources)
+        ):
+            return None
+        return cls(dirs, [(old, new) for old, new in moves if old != new])
+
+    def _cycle(self, pending):
+        """A source in pending whose moves lead back to it, or None"""
+        for start in pending:
+            path = pending[start]
+            for _ in range(len(pending)):
+                if path == start:
+                    return start
+                if path not in pending:
+                    break
+                path = pending[path]
+        return None
+
+    def steps(self):
+        """The moves in a safe order, with temporary names for cycles
+
+        Raises ValueError if two moves have the same target.
+        """
+        if len(set(new for _, new in self.moves)) != len(self.moves):
+            raise ValueError("Several files would get the same name")
+        pending = dict(self.moves)
+        waiting = {}  # target -> source of the move that waits for it
+        ready = []
+        for old, new in pending.items():
+            if new in pending:
+                waiting[new] = old
+            else:
+                ready.append(old)
+        steps = []
+        while pending:
+            if not ready:
+                # Only cycles are left: break one with a temporary name
+                old = self._cycle(pending)
+                if old is None:
+                    raise ValueError("Cannot order the renames")
+                temp = old + self.temp_suffix
+                while os.path.lexists(temp) or temp in pending:
+                    temp += "_"
+                steps.append((old, temp))
+                pending[temp] = pending.pop(old)
+                if pending[temp] in pending:
+                    waiting[pending[temp]] = temp
+                if old in waiting:
+                    ready.append(waiting.pop(old))
+                continue
+            old = ready.pop()
+            steps.append((old, pending.pop(old)))
+            if old in waiting:
+                ready.append(waiting.pop(old))
+        return steps
+
+    def execute(self):
+        """Do the renaming, return the applied mapping and the errors
+
+        The mapping takes the original paths to their final ones.
+        """
+        try:
+            steps = self.steps()
+        except ValueError as err:
+            return {}, [err]
+        errors = []
+        for path in self.dirs:
+            try:
+                os.makedirs(path)
+            except OSError as err:
+                if not os.path.isdir(path):
+                    errors.append(err)
+        origin = {}
+        for old, new in steps:
+            if os.path.lexists(new):
+                errors.append("%s: File exists" % new)
+                continue
+            try:
+                os.rename(old, new)
+            except OSError as err:
+                errors.append(err)
+                continue
+            origin[new] = origin.pop(old, old)
+        mapping = dict((old, new) for new, old in origin.items() if old != new)
+        return mapping, errors
+
+
+def update_renamed_paths(fm, mapping):
+    """Move tags, bookmarks and metadata along with renamed files
+
+    mapping takes old paths to new ones.  Paths below renamed directories
+    are moved too.  The tags and bookmarks are written once, and every
+    affected .metadata.json file once.
+    """
+    import json
+
+    if not mapping:
+        return
+    has_dirs = any(os.path.isdir(new) for new in mapping.values())
+
+    def remap(path):
+        if path in mapping:
+            return mapping[path]
+        if has_dirs:
+            parent = os.path.dirname(path)
+            while parent != path:
+                if parent in mapping:
+                    return mapping[parent] + path[len(parent) :]
+                path, parent = parent, os.path.dirname(parent)
+        return None
+
+    tags = fm.tags
+    if tags:
+        tags.sync()
+        changed = False
+        new_tags = {}
+        for path, tag in tags.tags.items():
+            new = remap(path)
+            changed = changed or new is not None
+            new_tags[new or path] = tag
+        if changed:
+            tags.tags = new_tags
+            tags.dump()
+
+    bookmarks = fm.bookmarks
+    bookmarks.update_if_outdated()
+    changed = False
+    for key, bfile in list(bookmarks):
+        new = remap(str(bfile))
+        if new is not None:
+            bookmarks.dct[key] = bookmarks.bookmarktype(new)
+            changed = True
+    if changed:
+        bookmarks.save()
+
+    # Metadata is stored by basename in the .metadata.json next to the file
+    if isinstance(fm.metadata, MetadataIndex):
+        fm.metadata.flush()
+    metafiles = {}
+
+    def load(metafile):
+        if metafile not in metafiles:
+            try:
+                with open(metafile, "r") as fobj:
+                    metafiles[metafile] = [json.load(fobj), False]
+            except (OSError, IOError, ValueError):
+                metafiles[metafile] = [None, False]
+        return metafiles[metafile]
+
+    # Take all entries out first, in case some files swapped their names
+    moved = []
+    for old, new in mapping.items():
+        source = load(os.path.join(os.path.dirname(old), ".metadata.json"))
+        if not source[0]:
+            continue
+        entry = source[0].pop(old, None)
+        if entry is None:
+            entry = source[0].pop(os.path.basename(old), None)
+        if entry is not None:
+            source[1] = True
+            moved.append((new, entry))
+    for new, entry in moved:
+        target = load(os.path.join(os.path.dirname(new), ".metadata.json"))
+        if target[0] is None:
+            target[0] = {}
+        target[0][os.path.basename(new)] = entry
+        target[1] = True
+    for metafile, (entries, changed) in metafiles.items():
+        if changed:
+            try:
+                with open(metafile, "w") as fobj:
+                    json.dump(entries, fobj, check_circular=True, indent=2)
+            except (OSError, IOError):
+                pass
+    if any(changed for _, changed in metafiles.values()):
+        fm.metadata.reset()
 
 
 class bulkrename(Command):
@@ -1108,7 +3181,9 @@ class bulkrename(Command):
     which does bulk renaming according to the changes you did in the file.
 
     This shell script is opened in an editor for you to review.
-    After you close it, it will be executed.
+    After you close it, it will be executed.  As long as it only contains
+    mkdir and mv commands, the renaming is done by ranger itself instead of
+    a shell, which is much faster for many files and handles swapped names.
     """
 
     def execute(self):
@@ -1179,32 +3254,46 @@ class bulkrename(Command):
                 cmdfile.write(script_content)
             cmdfile.flush()
 
-            # Open the script and let the user review it, then check if the
-            # script was modified by the user
+            # Open the script and let the user review it
             self.fm.execute_file([File(cmdfile.name)], app="editor")
-            cmdfile.seek(0)
-            script_was_edited = script_content != cmdfile.read()
 
-            # Do the renaming
-            self.fm.run(["/bin/sh", cmdfile.name], flags="w")
+            # Do the renaming, in-process unless the script was edited into
+            # something else than mkdir and mv
+            with (
+                open(cmdfile.name, "r", encoding="utf-8", errors="surrogateescape")
+                if py3
+                else open(cmdfile.name, "r")
+            ) as scriptfile:
+                script = scriptfile.read()
+            plan = RenamePlan.from_script(script, self.fm.thisdir.path)
+            if plan is None:
+                self.fm.run(["/bin/sh", cmdfile.name], flags="w")
+                mapping = None
+            else:
+                mapping, errors = plan.execute()
+                if errors:
+                    self.fm.notify(
+                        "Renamed %d files, %d errors, first: %s"
+                        % (len(mapping), len(errors), errors[0]),
+                        bad=True,
+                    )
+                else:
+                    self.fm.notify("Renamed %d files" % len(mapping))
 
-        # Retag the files, but only if the script wasn't changed during review,
-        # because only then we know which are the source and destination files.
-        if not script_was_edited:
-            tags_changed = False
-            for old, new in zip(filenames, new_filenames):
-                if old != new:
-                    oldpath = self.fm.thisdir.path + "/" + old
-                    newpath = self.fm.thisdir.path + "/" + new
-                    if oldpath in self.fm.tags:
-                        old_tag = self.fm.tags.tags[oldpath]
-                        self.fm.tags.remove(oldpath)
-                        self.fm.tags.tags[newpath] = old_tag
-                        tags_changed = True
-            if tags_changed:
-                self.fm.tags.dump()
-        else:
-            fm.notify("files have not been retagged")
+        # Retag the files.  When the script had to be run by the shell, we
+        # only know which are the source and destination files if it wasn't
+        # changed during review.
+        if mapping is None and script != script_content:
+            self.fm.notify("files have not been retagged")
+            return
+        if mapping is None:
+            cwd = self.fm.thisdir.path
+            mapping = dict(
+                (os.path.join(cwd, old), os.path.join(cwd, new))
+                for old, new in zip(filenames, new_filenames)
+                if old != new
+            )
+        update_renamed_paths(self.fm, mapping)
 
 
 class relink(Command):
@@ -1453,6 +3542,131 @@ class pmap(map_):
     context = "pager"
 
 
+def narrow_directory(directory, accept):
+    """Drop the files rejected by accept() from directory.files
+
+    This is a shortcut for Directory.refilter() when a filter became
+    stricter: only the currently visible files are tested instead of
+    running every filter over every file of the directory.
+    """
+    set_directory_files(directory, [fobj for fobj in directory.files if accept(fobj)])
+
+
+def set_directory_files(directory, files, pointer=None):
+    """Show files in directory, like the end of Directory.refilter()
+
+    If the caller knows where the pointer ends up in the new list, it is
+    moved there directly instead of looking the pointed file up again.
+    """
+    from time import time
+
+    directory.files = files
+    directory.last_update_time = time()
+    if files and pointer is not None:
+        directory.pointer = min(pointer, len(files) - 1)
+        directory.pointed_obj = files[directory.pointer]
+        directory.correct_pointer()
+        return
+    if directory.files and not directory.pointed_obj:
+        directory.pointed_obj = directory.files[0]
+    elif not directory.files:
+        directory.content_loaded = False
+        directory.pointed_obj = None
+    directory.move_to_obj(directory.pointed_obj)
+
+
+class ScoutFilter(object):
+    """Temporary filter installed by scout as you type
+
+    It quacks like the compiled regular expression it stands for, but
+    answers from the set of basenames that matched, as long as the
+    directory listing it was computed for is still current.
+    """
+
+    def __init__(self, regex, directory, key, names):
+        self.regex = regex
+        self.pattern = regex.pattern
+        self.directory = directory
+        self.files_all = directory.files_all
+        self.key = key
+        self.names = names
+
+    def search(self, basename):
+        if self.directory.files_all is self.files_all:
+            return basename in self.names
+        return self.regex.search(basename)
+
+
+class NegatedRegex(object):
+    """A compiled regular expression whose search() succeeds where the
+    wrapped expression fails.
+
+    scout -v uses this instead of rewriting the pattern into
+    ^(?:(?!pattern).)*$, which makes the regex engine run a lookahead at
+    every position of every name.
+    """
+
+    def __init__(self, regex):
+        self.regex = regex
+        self.pattern = regex.pattern
+        self.flags = regex.flags
+
+    def search(self, string, *args):
+        return None if self.regex.search(string, *args) else True
+
+
+class ScoutEngine(object):
+    """Match state of scout that outlives the per-keypress command objects
+
+    The files of the current directory are copied, so that sorting the
+    directory in place does not mix them up, and their lowercased basenames
+    are cached.  The files that matched the previous pattern are kept so
+    that a pattern that only grew is tested against the previous matches
+    instead of the whole directory.
+    """
+
+    def __init__(self):
+        self._reset(None)
+
+    def _reset(self, directory):
+        self.directory = directory
+        self.files_all = directory.files_all if directory else None
+        self.files = list(self.files_all) if self.files_all else []
+        self._names = {}
+        self.key = None
+        self.positions = None
+
+    def names(self, ignore_case):
+        """Return the (lowercased) basenames of the cached listing"""
+        try:
+            return self._names[ignore_case]
+        except KeyError:
+            pass
+        if ignore_case:
+            names = [fobj.basename.lower() for fobj in self.files]
+        else:
+            names = [fobj.basename for fobj in self.files]
+        self._names[ignore_case] = names
+        return names
+
+    def match(self, directory, key, test, ignore_case, refines):
+        """Return the files of directory that pass test
+
+        key identifies the pattern, refines(old_key) tells whether every
+        match of key is also a match of old_key.
+        """
+        if directory is not self.directory or directory.files_all is not self.files_all:
+            self._reset(directory)
+        names = self.names(ignore_case)
+        if self.key is not None and refines(self.key):
+            candidates = self.positions
+        else:
+            candidates = range(len(names))
+        self.positions = [i for i in candidates if test(names[i])]
+        self.key = key
+        return [self.files[i] for i in self.positions]
+
+
 class scout(Command):
     """:scout [-FLAGS...] <pattern>
 
@@ -1495,9 +3709,13 @@ class scout(Command):
     INVERT = "v"
     # pylint: enable=bad-whitespace
 
+    engine = ScoutEngine()
+
     def __init__(self, *args, **kwargs):
         super(scout, self).__init__(*args, **kwargs)
         self._regex = None
+        self._positive_regex = None
+        self._test = None
         self.flags, self.pattern = self.parse_flags()
 
     def execute(self):  # pylint: disable=too-many-branches
@@ -1513,12 +3731,22 @@ class scout(Command):
         if (self.MARK in flags or self.UNMARK in flags) and thisdir.files:
             value = flags.find(self.MARK) > flags.find(self.UNMARK)
             if self.FILTER in flags:
-                for fobj in thisdir.files:
-                    thisdir.mark_item(fobj, value)
+                mark_items(thisdir, thisdir.files, value)
             else:
-                for fobj in thisdir.files:
-                    if regex.search(fobj.relative_path):
-                        thisdir.mark_item(fobj, value)
+                test, ignore_case = self._compile()
+                mark_items(
+                    thisdir,
+                    [
+                        fobj
+                        for fobj in thisdir.files
+                        if test(
+                            fobj.relative_path_lower
+                            if ignore_case
+                            else fobj.relative_path
+                        )
+                    ],
+                    value,
+                )
 
         if self.PERM_FILTER in flags:
             thisdir.filter = regex if pattern else None
@@ -1550,11 +3778,14 @@ class scout(Command):
 
     def quick(self):
         asyoutype = self.AS_YOU_TYPE in self.flags
-        if self.FILTER in self.flags:
-            self.fm.thisdir.temporary_filter = self._build_regex()
         if self.PERM_FILTER in self.flags and asyoutype:
+            if self.FILTER in self.flags:
+                self.fm.thisdir.temporary_filter = self._build_regex()
             self.fm.thisdir.filter = self._build_regex()
-        if self.FILTER in self.flags or self.PERM_FILTER in self.flags:
+            self.fm.thisdir.refilter()
+        elif self.FILTER in self.flags:
+            self._apply_temporary_filter()
+        elif self.PERM_FILTER in self.flags:
             self.fm.thisdir.refilter()
         if self._count(move=asyoutype) == 1 and self.AUTO_OPEN in self.flags:
             return True
@@ -1563,6 +3794,94 @@ class scout(Command):
     def tab(self, tabnum):
         self._count(move=True, offset=tabnum)
 
+    def _apply_temporary_filter(self):
+        thisdir = self.fm.thisdir
+        if thisdir.files_all is None:
+            return
+        regex = self._build_regex()
+        test, ignore_case = self._compile()
+        key = (self.flags, self.pattern)
+        matches = self.engine.match(thisdir, key, test, ignore_case, self._refines)
+        names = set(fobj.basename for fobj in matches)
+
+        previous = thisdir.temporary_filter
+        thisdir.temporary_filter = ScoutFilter(regex, thisdir, key, names)
+        if (
+            isinstance(previous, ScoutFilter)
+            and previous.directory is thisdir
+            and previous.files_all is thisdir.files_all
+            and self._refines(previous.key)
+        ):
+            narrow_directory(thisdir, lambda fobj: fobj.basename in names)
+        else:
+            thisdir.refilter()
+
+    def _refines(self, key):
+        """Does every match of this pattern also match the pattern of key?
+
+        That holds if the pattern only grew at the end, unless it is a
+        regular expression, an inverted match or anchored at the end.
+        """
+        flags, pattern = key
+        return (
+            flags == self.flags
+            and self.pattern.startswith(pattern)
+            and not pattern.endswith("$")
+            and pattern != "."
+            and self.SM_REGEX not in flags
+            and self.INVERT not in flags
+        )
+
+    def _compile(self):
+        """Return a test function for names and whether it wants them lowercased
+
+        Plain patterns are tested with string methods.  Case insensitive
+        matching runs on lowercased names, so that the case folding can be
+        cached instead of being done by the regex engine on every call.
+        """
+        if self._test is not None:
+            return self._test
+
+        flags = self.flags
+        pattern = self.pattern
+        ignore_case = self.IGNORE_CASE in flags or (
+            self.SMART_CASE in flags and pattern.islower()
+        )
+        if ignore_case:
+            pattern = pattern.lower()
+
+        if pattern == ".":
+            return (self._build_regex().search, False)
+
+        self._build_regex()
+        regex = self._positive_regex
+        if (
+            self.SM_REGEX in flags
+            or pattern.startswith("^")
+            or pattern.endswith("$")
+        ):
+            test = regex.search
+            ignore_case = False
+        elif self.SM_GLOB in flags or self.SM_LETTERSKIP in flags:
+            if ignore_case:
+                options = re.UNICODE  # pylint: disable=no-member
+                test = re.compile(regex.pattern.lower(), options).search
+            else:
+                test = regex.search
+        else:
+
+            def test(name):
+                return pattern in name
+
+        if self.INVERT in flags:
+            positive = test
+
+            def test(name):  # pylint: disable=function-redefined
+                return not positive(name)
+
+        self._test = (test, ignore_case)
+        return self._test
+
     def _build_regex(self):
         if self._regex is not None:
             return self._regex
@@ -1594,10 +3913,6 @@ class scout(Command):
 
         regex = frmat % regex
 
-        # Invert regular expression if necessary
-        if self.INVERT in flags:
-            regex = "^(?:(?!%s).)*$" % regex
-
         # Compile Regular Expression
         # pylint: disable=no-member
         options = re.UNICODE
@@ -1605,9 +3920,15 @@ class scout(Command):
             options |= re.IGNORECASE
         # pylint: enable=no-member
         try:
-            self._regex = re.compile(regex, options)
+            self._positive_regex = re.compile(regex, options)
         except re.error:
-            self._regex = re.compile("")
+            self._positive_regex = re.compile("")
+
+        # Invert the match by negating the result instead of the pattern
+        if self.INVERT in flags:
+            self._regex = NegatedRegex(self._positive_regex)
+        else:
+            self._regex = self._positive_regex
         return self._regex
 
     def _count(self, move=False, offset=0):
@@ -1622,38 +3943,72 @@ class scout(Command):
         if pattern == "..":
             return 1
 
-        deq = deque(cwd.files)
-        deq.rotate(-cwd.pointer - offset)
-        i = offset
-        regex = self._build_regex()
-        for fsobj in deq:
-            if regex.search(fsobj.relative_path):
+        files = cwd.files
+        size = len(files)
+        test, ignore_case = self._compile()
+        start = cwd.pointer + offset
+        for i in range(size):
+            fsobj = files[(start + i) % size]
+            if test(fsobj.relative_path_lower if ignore_case else fsobj.relative_path):
                 count += 1
                 if move and count == 1:
-                    cwd.move(to=(cwd.pointer + i) % len(cwd.files))
+                    cwd.move(to=(start + i) % size)
                     self.fm.thisfile = cwd.pointed_obj
             if count > 1:
                 return count
-            i += 1
 
         return count == 1
 
 
 class narrow(Command):
     """
-    :narrow
+    :narrow [-a]
 
     Show only the files selected right now. If no files are selected,
     disable narrowing.
+
+    With -a, do this in every directory with marked files instead of only
+    the current one, and disable narrowing in the others.
     """
 
     def execute(self):
-        if self.fm.thisdir.marked_items:
-            selection = [f.basename for f in self.fm.thistab.get_selection()]
-            self.fm.thisdir.narrow_filter = selection
+        flags, _ = self.parse_flags()
+        if "a" in flags:
+            for directory in list(self.fm.directories.values()):
+                if directory.marked_items or directory.narrow_filter:
+                    self._narrow(directory, None)
         else:
-            self.fm.thisdir.narrow_filter = None
-        self.fm.thisdir.refilter()
+            self._narrow(self.fm.thisdir, self.fm.thistab.get_selection)
+
+    @staticmethod
+    def _narrow(directory, get_selection):
+        if not directory.marked_items:
+            if directory.narrow_filter:
+                directory.narrow_filter = None
+                directory.refilter()
+            return
+
+        # Like get_selection(), without its garbage collection of
+        # marked_items, which is quadratic in the number of marked files
+        selection = [fobj for fobj in directory.files or () if fobj.marked]
+        if not selection and get_selection:
+            selection = get_selection()
+        if not selection:
+            directory.narrow_filter = None
+            directory.refilter()
+            return
+
+        # A set, so that refilter() tests each file in constant time
+        names = set(fobj.basename for fobj in selection)
+        previous = directory.narrow_filter
+        directory.narrow_filter = names
+        if directory.files and (not previous or names <= set(previous)):
+            # Only ever narrows what is shown now.  Compare paths, in a
+            # flattened view several files can share a basename.
+            paths = set(fobj.path for fobj in selection)
+            narrow_directory(directory, lambda fobj: fobj.path in paths)
+        else:
+            directory.refilter()
 
 
 class filter_inode_type(Command):
@@ -1668,12 +4023,176 @@ class filter_inode_type(Command):
         l display links
     """
 
+    index = InodeTypeIndex()
+    # (directory, its files_all, the files without type filter, the files
+    # that this command showed, their positions in the unfiltered files)
+    _state = (None, None, None, None, None)
+
     def execute(self):
-        if not self.arg(1):
-            self.fm.thisdir.inode_type_filter = ""
+        from bisect import bisect_left
+
+        thisdir = self.fm.thisdir
+        types = self.arg(1) or ""
+        directory, files_all, base, shown, shown_positions = filter_inode_type._state
+        if self.fm.settings.global_inode_type_filter:
+            base = None
+        elif not thisdir.inode_type_filter:
+            base = shown = thisdir.files
+            shown_positions = None
+        elif (
+            directory is not thisdir
+            or files_all is not thisdir.files_all
+            or shown is not thisdir.files
+        ):
+            # The files have been refiltered since, the unfiltered list is gone
+            base = None
+
+        thisdir.inode_type_filter = types
+        if base is None:
+            thisdir.refilter()
+            return
+
+        # Where the pointer is in the unfiltered files
+        current = thisdir.pointer
+        if not 0 <= current < len(shown) or shown[current] is not thisdir.pointed_obj:
+            current = None
+        elif shown_positions is not None:
+            current = shown_positions[current]
+
+        if types:
+            positions = self.index.select(base, types)
+            files = [base[i] for i in positions]
+            pointer = None if current is None else bisect_left(positions, current)
         else:
-            self.fm.thisdir.inode_type_filter = self.arg(1)
-        self.fm.thisdir.refilter()
+            positions = None
+            files = base
+            pointer = current
+        set_directory_files(thisdir, files, pointer)
+        filter_inode_type._state = (
+            thisdir,
+            thisdir.files_all,
+            base,
+            thisdir.files,
+            positions,
+        )
+
+
+class CachedFilter(FileManagerAware):
+    """A filter_stack filter that remembers its result for every entry
+
+    The results are kept in a bytearray parallel to the current
+    directory's files_all (0 unknown, 1 rejected, 2 accepted) and are
+    thrown away when files_all is replaced.  refilter() stops at the first
+    filter that rejects an entry, so a new filter is only evaluated for the
+    entries that the filters below it accept, and popping or rotating the
+    stack doesn't run any predicate again.
+    """
+
+    _index = (None, {})
+
+    def __init__(self, subfilter):
+        self.subfilter = subfilter
+        self._files = None
+        self.results = bytearray()
+
+    @staticmethod
+    def index(files):
+        """Map the ids of the entries to their positions, shared by all"""
+        if CachedFilter._index[0] is not files:
+            CachedFilter._index = (
+                files,
+                dict((id(fobj), i) for i, fobj in enumerate(files)),
+            )
+        return CachedFilter._index[1]
+
+    def prepare(self, files):
+        """Forget the results if the directory has been reloaded"""
+        if self._files is not files:
+            self._files = files
+            self.results = bytearray(len(files))
+
+    def evaluate(self, fobj):
+        return self.subfilter(fobj)
+
+    def __call__(self, fobj):
+        files = self.fm.thisdir.files_all if self.fm.thisdir else None
+        i = self.index(files).get(id(fobj)) if files else None
+        if i is None or files[i] is not fobj:
+            # Not an entry of the current directory
+            return bool(self.evaluate(fobj))
+        self.prepare(files)
+        result = self.results[i]
+        if not result:
+            result = self.results[i] = 2 if self.evaluate(fobj) else 1
+        return result == 2
+
+    def complete(self, files):
+        """All results for files, as a bytearray, if they are all known"""
+        self.prepare(files)
+        return self.results if 0 not in self.results else None
+
+    def decompose(self):
+        inner = self.subfilter.decompose()
+        if inner == [self.subfilter]:
+            return [self]
+        return [f if isinstance(f, CachedFilter) else CachedFilter(f) for f in inner]
+
+    def __str__(self):
+        return str(self.subfilter)
+
+
+class CachedCombinator(CachedFilter):
+    """An and/or/not of cached filters
+
+    The results of the subfilters are combined, either entry by entry or,
+    when they are known for all entries, as whole bitmaps at once, so no
+    predicate runs twice.
+    """
+
+    # 2 (accepted) -> 1, everything else -> 0, and back
+    to_bits = bytes(1 if c == 2 else 0 for c in range(256))
+    from_bits = bytes(2 if c else 1 for c in range(256))
+
+    def __init__(self, operator, subfilters):
+        CachedFilter.__init__(self, None)
+        self.operator = operator
+        self.subfilters = subfilters
+
+    def prepare(self, files):
+        if self._files is files:
+            return
+        CachedFilter.prepare(self, files)
+        # Combine whole bitmaps if the subfilters know all their results
+        bitmaps = [f.complete(files) for f in self.subfilters]
+        if not files or None in bitmaps:
+            return
+        size = len(files)
+        values = [int.from_bytes(b.translate(self.to_bits), "big") for b in bitmaps]
+        if self.operator == "not":
+            combined = values[0] ^ int.from_bytes(b"\1" * size, "big")
+        elif self.operator == "and":
+            combined = values[0] & values[1]
+        else:
+            combined = values[0] | values[1]
+        combined = combined.to_bytes(size, "big")
+        self.results = bytearray(combined.translate(self.from_bits))
+
+    def evaluate(self, fobj):
+        if self.operator == "not":
+            return not self.subfilters[0](fobj)
+        if self.operator == "and":
+            return all(f(fobj) for f in self.subfilters)
+        return any(f(fobj) for f in self.subfilters)
+
+    def decompose(self):
+        return list(self.subfilters)
+
+    def __str__(self):
+        if self.operator == "not":
+            return "<Filter: not {}>".format(str(self.subfilters[0]))
+        return "<Filter: {}>".format(
+            " {} ".format(self.operator).join(map(str, self.subfilters))
+        )
 
 
 class filter_stack(Command):
@@ -1688,36 +4207,45 @@ class filter_stack(Command):
         filter_stack rotate [N=1]
         filter_stack clear
         filter_stack show
+
+    The filters remember their result for every file, see CachedFilter.
     """
 
+    combinator_arity = {"and": 2, "or": 2, "not": 1}
+
     def execute(self):
         from ranger.core.filter_stack import SIMPLE_FILTERS, FILTER_COMBINATORS
 
         subcommand = self.arg(1)
+        stack = self.fm.thisdir.filter_stack
 
         if subcommand == "add":
             try:
-                self.fm.thisdir.filter_stack.append(
-                    SIMPLE_FILTERS[self.arg(2)](self.rest(3))
-                )
+                stack.append(CachedFilter(SIMPLE_FILTERS[self.arg(2)](self.rest(3))))
             except KeyError:
-                FILTER_COMBINATORS[self.arg(2)](self.fm.thisdir.filter_stack)
+                arity = self.combinator_arity.get(self.arg(2))
+                if arity is None or len(stack) < arity:
+                    FILTER_COMBINATORS[self.arg(2)](stack)
+                else:
+                    subfilters = [
+                        f if isinstance(f, CachedFilter) else CachedFilter(f)
+                        for f in stack[-arity:]
+                    ]
+                    del stack[-arity:]
+                    stack.append(CachedCombinator(self.arg(2), subfilters))
         elif subcommand == "pop":
-            self.fm.thisdir.filter_stack.pop()
+            stack.pop()
         elif subcommand == "decompose":
-            inner_filters = self.fm.thisdir.filter_stack.pop().decompose()
+            inner_filters = stack.pop().decompose()
             if inner_filters:
-                self.fm.thisdir.filter_stack.extend(inner_filters)
+                stack.extend(inner_filters)
         elif subcommand == "clear":
             self.fm.thisdir.filter_stack = []
         elif subcommand == "rotate":
             rotate_by = int(self.arg(2) or self.quantifier or 1)
-            self.fm.thisdir.filter_stack = (
-                self.fm.thisdir.filter_stack[-rotate_by:]
-                + self.fm.thisdir.filter_stack[:-rotate_by]
-            )
+            self.fm.thisdir.filter_stack = stack[-rotate_by:] + stack[:-rotate_by]
         elif subcommand == "show":
-            stack = list(map(str, self.fm.thisdir.filter_stack))
+            stack = list(map(str, stack))
             pager = self.fm.ui.open_pager()
             pager.set_source(["Filter stack: "] + stack)
             pager.move(to=100, percentage=True)
@@ -1729,44 +4257,708 @@ class filter_stack(Command):
         self.fm.thisdir.refilter()
 
 
+class TrigramIndex(object):
+    """An on-disk index of the trigrams in the files of a directory tree
+
+    For every file, the index stores its mtime and size, and the set of
+    (lowercase) byte trigrams in its words.  A literal string can only
+    occur in files that contain all of its trigrams, so :grep -t only has
+    to read those, plus the files that changed since they were indexed.
+    """
+
+    max_query_trigrams = 32
+    # Lowercases ASCII word characters and turns everything else into spaces
+    word_table = bytes(
+        ord(chr(c).lower()) if chr(c).isalnum() or c == 95 else 32 for c in range(128)
+    ) + b" " * 128
+
+    def __init__(self, filename):
+        import sqlite3
+
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS trigrams (
+                tri INTEGER, file INTEGER, PRIMARY KEY (tri, file)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS trigrams_file ON trigrams (file);
+            """
+        )
+
+    @staticmethod
+    def trigrams(data):
+        """The trigrams within the words of data, as sorted integers
+
+        Only trigrams of word characters are used, for the index and the
+        queries alike, since files have far fewer distinct words than
+        lines.  A trigram of word characters in the query still appears
+        within some word of every matching file.
+        """
+        import array
+
+        found = set()
+        for word in set(data.translate(TrigramIndex.word_table).split()):
+            found.update(zip(word, word[1:], word[2:]))
+        return array.array("i", sorted(a << 16 | b << 8 | c for a, b, c in found))
+
+    def files(self):
+        """Map the indexed paths to (id, mtime, size)"""
+        return dict(
+            (path, (fid, mtime, size))
+            for fid, path, mtime, size in self.db.execute("SELECT * FROM files")
+        )
+
+    def candidates(self, literal):
+        """The ids of the files that may contain literal, None if any may"""
+        # Any subset of the trigrams narrows the files down correctly, and
+        # SQLite limits the number of terms in a compound SELECT
+        query = list(self.trigrams(literal))[: self.max_query_trigrams]
+        if not query:
+            return None
+        select = "SELECT file FROM trigrams WHERE tri = ?"
+        sql = " INTERSECT ".join([select] * len(query))
+        return set(row[0] for row in self.db.execute(sql, query))
+
+    def update(self, path, mtime, size, trigrams):
+        self.remove([path])
+        cursor = self.db.execute(
+            "INSERT INTO files (path, mtime, size) VALUES (?, ?, ?)",
+            (path, mtime, size),
+        )
+        fid = cursor.lastrowid
+        self.db.executemany(
+            "INSERT INTO trigrams VALUES (?, ?)", ((tri, fid) for tri in trigrams)
+        )
+
+    def remove(self, paths):
+        for path in paths:
+            row = self.db.execute(
+                "SELECT id FROM files WHERE path = ?", (path,)
+            ).fetchone()
+            if row:
+                self.db.execute("DELETE FROM trigrams WHERE file = ?", row)
+                self.db.execute("DELETE FROM files WHERE id = ?", row)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def grep_worker(tasks, results, pattern, flags, max_line_length):
+    """Search the files that come in batches on the tasks queue
+
+    Runs in a worker process.  The batches consist of (path, reindex)
+    pairs.  For every batch, a list of (path, line number, line) and a
+    list of (path, mtime, size, trigrams) for the files to reindex are put
+    on the results queue, and None when the worker gets None.  Files with
+    NUL bytes in their first block are considered binary and skipped.
+    """
+    import mmap
+    import signal
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    regex = re.compile(pattern, flags)
+    while True:
+        batch = tasks.get()
+        if batch is None:
+            results.put(None)
+            return
+        matches = []
+        indexed = []
+        for path, reindex in batch:
+            try:
+                with open(path, "rb") as fobj:
+                    stat = os.fstat(fobj.fileno())
+                    if not stat.st_size or b"\0" in fobj.read(8192):
+                        if reindex:
+                            indexed.append((path, stat.st_mtime, stat.st_size, ()))
+                        continue
+                    data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, IOError, ValueError):
+                continue
+            try:
+                if reindex:
+                    trigrams = TrigramIndex.trigrams(data[:])
+                    indexed.append((path, stat.st_mtime, stat.st_size, trigrams))
+                lineno = 1
+                counted = 0
+                pos = 0
+                while True:
+                    match = regex.search(data, pos)
+                    if match is None:
+                        break
+                    start = data.rfind(b"\n", 0, match.start()) + 1
+                    end = data.find(b"\n", match.end())
+                    if end == -1:
+                        end = len(data)
+                    lineno += data[counted:start].count(b"\n")
+                    counted = start
+                    line = data[start : min(end, start + max_line_length)]
+                    matches.append((path, lineno, line.decode("utf-8", "replace")))
+                    pos = end + 1
+                    if pos > len(data):
+                        break
+            finally:
+                data.close()
+        results.put((matches, indexed))
+
+
+class GrepLoader(Loadable, FileManagerAware):
+    """Searches the contents of files and directory trees in the background
+
+    The trees are walked here with scandir, skipping symlinks, non-regular
+    files and the names in ignored_names, and the files are handed in
+    batches to worker processes that mmap and search them.  The matches
+    are appended to the results list as they come in, and the pager is
+    redrawn to show them.  The workers are killed once max_results matches
+    are found, or when the task is removed from the task view.
+
+    With index_dir, every selected directory gets a TrigramIndex in there.
+    Unchanged files that can't contain the literal are skipped, and the
+    changed ones are searched and reindexed.
+    """
+
+    progressbar_supported = True
+    batch_size = 64
+    max_results = 100000
+    max_line_length = 500
+    ignored_names = frozenset(
+        [".git", ".hg", ".svn", ".bzr", "node_modules", "__pycache__", ".tox"]
+    )
+
+    def __init__(
+        self, paths, pattern, flags, results, lines, literal=None, index_dir=None
+    ):
+        self.paths = paths
+        self.pattern = pattern
+        self.flags = flags
+        self.results = results
+        self.lines = lines
+        self.literal = literal
+        self.index_dir = index_dir
+        self.indexes = {}
+        self.workers = []
+        self.searched = 0
+        self.skipped = 0
+        self.cancelled = False
+        descr = "Searching for " + os.fsdecode(pattern)
+        Loadable.__init__(self, self.generate(), descr)
+
+    def destroy(self):
+        self.cancelled = True
+        self._stop()
+
+    def _stop(self):
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join(0.1)
+        for index in self.indexes.values():
+            index.close()
+        self.indexes.clear()
+
+    def _walk(self, root):
+        """Yield the regular files below root, with their DirEntry if any"""
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            if not os.path.isdir(path) or os.path.islink(path):
+                if os.path.isfile(path):
+                    yield path, None
+                continue
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            subdirs = []
+            for entry in entries:
+                if entry.name in self.ignored_names:
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry.path, entry
+                except OSError:
+                    pass
+            stack.extend(reversed(sorted(subdirs)))
+
+    def _open_index(self, root):
+        import hashlib
+
+        if not os.path.isdir(self.index_dir):
+            os.makedirs(self.index_dir)
+        name = hashlib.sha1(os.fsencode(root)).hexdigest() + ".sqlite"
+        index = TrigramIndex(os.path.join(self.index_dir, name))
+        self.indexes[root.rstrip(os.sep) + os.sep] = index
+        return index
+
+    def _files(self, root):
+        """Yield (path, reindex) for the files below root to search"""
+        index = None
+        if self.index_dir and os.path.isdir(root) and not os.path.islink(root):
+            index = self._open_index(root)
+            known = index.files()
+            candidates = index.candidates(self.literal) if self.literal else None
+        for path, entry in self._walk(root):
+            if index is None:
+                yield path, False
+                continue
+            try:
+                stat = entry.stat(follow_symlinks=False) if entry else os.stat(path)
+            except OSError:
+                continue
+            fid, mtime, size = known.pop(path, (None, None, None))
+            if mtime != stat.st_mtime or size != stat.st_size:
+                yield path, True
+            elif candidates is None or fid in candidates:
+                yield path, False
+            else:
+                self.skipped += 1
+        if index is not None:
+            index.remove(known)
+
+    def _collect(self, results, block=False):
+        """Move the available results into the list, return finished workers"""
+        import queue
+
+        finished = 0
+        while True:
+            try:
+                message = results.get(block, 0.05)
+            except queue.Empty:
+                break
+            block = False
+            if message is None:
+                finished += 1
+                continue
+            matches, indexed = message
+            cwd = self.fm.thisdir.path
+            for path, lineno, line in matches:
+                if len(self.results) >= self.max_results:
+                    break
+                self.results.append((path, lineno))
+                self.lines.append(
+                    "%s:%d:%s" % (os.path.relpath(path, cwd), lineno, line)
+                )
+            for path, mtime, size, trigrams in indexed:
+                for root, index in self.indexes.items():
+                    if path.startswith(root):
+                        index.update(path, mtime, size, trigrams)
+                        break
+        if self.fm.ui.pager.visible:
+            self.fm.ui.pager.need_redraw = True
+        return finished
+
+    def generate(self):
+        import multiprocessing
+
+        context = multiprocessing.get_context("fork")
+        tasks = context.Queue()
+        results = context.Queue()
+        for _ in range(os.cpu_count() or 1):
+            worker = context.Process(
+                target=grep_worker,
+                args=(tasks, results, self.pattern, self.flags, self.max_line_length),
+            )
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        try:
+            batch = []
+            for item in (item for root in self.paths for item in self._files(root)):
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    tasks.put(batch)
+                    self.searched += len(batch)
+                    batch = []
+                    self._collect(results)
+                    if len(self.results) >= self.max_results:
+                        break
+                    yield
+            else:
+                if batch:
+                    tasks.put(batch)
+                    self.searched += len(batch)
+            for _ in self.workers:
+                tasks.put(None)
+            running = len(self.workers)
+            while running and len(self.results) < self.max_results:
+                running -= self._collect(results, block=True)
+                self.description = "Searching: %d files, %d matches" % (
+                    self.searched,
+                    len(self.results),
+                )
+                if not any(worker.is_alive() for worker in self.workers):
+                    break
+                yield
+            self._collect(results)
+        finally:
+            self._stop()
+        if self.cancelled:
+            return
+        if len(self.results) >= self.max_results:
+            message = "grep: stopped after %d matches in %d files"
+        else:
+            message = "grep: %d matches in %d files"
+        message %= (len(self.results), self.searched)
+        if self.skipped:
+            message += " (%d skipped by the index)" % self.skipped
+        self.fm.notify(message)
+
+
 class grep(Command):
-    """:grep <string>
+    """:grep [-iFt] <pattern>
+
+    Looks for a regular expression (a string with -F) in all marked files
+    or directories, ignoring case with -i.  The search runs in the
+    background on all cores; binary files and VCS directories are skipped.
+
+    The pattern is a Python regular expression, not grep's basic syntax:
+    "+", "?", "|", "()" and "{}" are operators unless escaped with a
+    backslash, as with grep -E, and \\< and \\> are written \\b.  At most
+    GrepLoader.max_results matches are shown.
+
+    With -t, a trigram index of each searched directory is kept in the
+    data directory and brought up to date on every search.  Searches for
+    literal strings with a word of 3 or more characters then only read the
+    files that may contain them.
+
+    The matching lines are shown in the pager as they are found.  Use
+    :grep_jump (mapped to alt-n and alt-p) to go to the files.
+    """
+
+    index_dirname = "grep_index"
+    results = []
+    lines = []
+    position = -1
+    loader = None
+
+    def execute(self):
+        flags, pattern = self.parse_flags()
+        if not pattern:
+            return
+        pattern = os.fsencode(pattern)
+        literal = None
+        if "F" in flags:
+            literal = pattern
+            pattern = re.escape(pattern)
+        elif not re.search(rb"[.^$*+?{}\[\]\\|()]", pattern):
+            literal = pattern
+        regex_flags = re.MULTILINE | (re.IGNORECASE if "i" in flags else 0)
+        try:
+            re.compile(pattern, regex_flags)
+        except re.error as err:
+            self.fm.notify("Invalid pattern: %s" % err, bad=True)
+            return
+        index_dir = None
+        if "t" in flags:
+            index_dir = self.fm.datapath(self.index_dirname)
+            if not index_dir:
+                self.fm.notify("No data directory for the index", bad=True)
+
+        # A search that is still running would keep filling the lists
+        if grep.loader is not None:
+            self.fm.loader.remove(grep.loader)
+            grep.loader = None
+        # Fill the lists in place, so the pager keeps showing them
+        del grep.results[:]
+        del grep.lines[:]
+        grep.position = -1
+        paths = [f.path for f in self.fm.thistab.get_selection()]
+        grep.loader = GrepLoader(
+            paths,
+            pattern,
+            regex_flags,
+            grep.results,
+            grep.lines,
+            literal=literal,
+            index_dir=index_dir,
+        )
+        self.fm.loader.add(grep.loader)
+        pager = self.fm.ui.open_pager()
+        pager.set_source(grep.lines)
+
+
+class grep_jump(Command):
+    """:grep_jump [-e] [<n>|+<n>|-<n>]
 
-    Looks for a string in all marked files or directories
+    Goes to the file of the n-th match of the last :grep, or n matches
+    forward or back (the next one by default).  With -e, the file is
+    opened in $EDITOR at the line of the match.
     """
 
     def execute(self):
-        if self.rest(1):
-            action = ["grep", "--line-number"]
-            action.extend(["-e", self.rest(1), "-r"])
-            action.extend(f.path for f in self.fm.thistab.get_selection())
-            self.fm.execute_command(action, flags="p")
+        # Not parse_flags(), "-3" is a position here
+        args = self.args[1:]
+        edit = "-e" in args
+        arg = "".join(a for a in args if a != "-e")
+        if not grep.results:
+            self.fm.notify("No grep results", bad=True)
+            return
+        try:
+            if not arg:
+                position = grep.position + 1
+            elif arg[0] in "+-":
+                position = grep.position + int(arg)
+            else:
+                position = int(arg) - 1
+        except ValueError:
+            self.fm.notify("Syntax: grep_jump [-e] [<n>|+<n>|-<n>]", bad=True)
+            return
+        position = max(0, min(position, len(grep.results) - 1))
+        grep.position = position
+        path, lineno = grep.results[position]
+        if self.fm.ui.pager.visible:
+            self.fm.ui.close_pager()
+        self.fm.select_file(path)
+        self.fm.notify(grep.lines[position])
+        if edit:
+            editor = os.environ.get("VISUAL") or os.environ.get("EDITOR") or "vi"
+            self.fm.run([editor, "+%d" % lineno, path])
+
+
+class FlatLoader(Loadable, FileManagerAware):
+    """Fills a flattened directory breadth-first, showing entries early
+
+    Instead of walking the whole tree before anything is shown, the
+    entries are published to the directory after the first batch and then
+    whenever their number has doubled, so sorting them costs about as much
+    as sorting them once.  The entries are created without stat()ing them,
+    except when sorting by size or time needs it; the rows around the
+    pointer are loaded when the directory is drawn.  At most max_entries
+    entries are loaded.  Removing the task from the task view stops the
+    walk and keeps what has been found so far; a new :flat in the same
+    directory discards it instead.  Every publish hands the directory a
+    new list, so caches keyed on the identity of files_all see the new
+    entries, and the marks are carried over by path like ranger does.
+
+    While attached, the loader replaces the directory's load_content and
+    load_content_if_outdated, since ranger would otherwise walk the whole
+    tree on every redraw to find the newest mtime.
+    """
+
+    progressbar_supported = True
+    first_batch = 1000
+    check_interval = 5
+    stat_sort_keys = frozenset(["size", "mtime", "ctime", "atime"])
+    active = {}  # the latest FlatLoader by directory path
+
+    def __init__(self, directory, level, max_entries):
+        self.directory = directory
+        self.level = level
+        self.max_entries = max_entries
+        self.mtimes = {}
+        self.truncated = False
+        self.last_check = 0
+        self.marked_paths = set()
+        self.published = 0
+        self._cancelled = False
+        self._discard = False
+        Loadable.__init__(self, self.generate(), "Flattening " + directory.path)
+
+    @classmethod
+    def start(cls, directory, level, max_entries):
+        """Flatten the directory, replacing any loader still flattening it"""
+        cls.stop(directory)
+        loader = cls(directory, level, max_entries)
+        cls.active[directory.path] = loader
+        cls.fm.loader.add(loader)
+
+    @classmethod
+    def stop(cls, directory):
+        """Remove the loader of the directory, throwing its entries away"""
+        loader = cls.active.pop(directory.path, None)
+        if loader is not None:
+            loader._discard = True  # pylint: disable=protected-access
+            cls.fm.loader.remove(loader)
+
+    @staticmethod
+    def detach(directory):
+        """Give the directory back its own loading methods"""
+        for name in ("load_content", "load_content_if_outdated"):
+            vars(directory).pop(name, None)
+
+    def attach(self):
+        self.detach(self.directory)
+        self.directory.load_content = self.reload
+        self.directory.load_content_if_outdated = self.load_if_outdated
+
+    def destroy(self):
+        self._cancelled = True
+        if self.load_generator is not None:
+            self.load_generator.close()
+
+    def reload(self, *_, **__):
+        if not self.directory.loading:
+            self.start(self.directory, self.level, self.max_entries)
+
+    def load_if_outdated(self, *_, **__):
+        """Load the visible rows, reload if a directory has changed"""
+        import time
+
+        directory = self.directory
+        changed = self._load_visible()
+        if directory.loading or time.time() - self.last_check < self.check_interval:
+            return changed
+        self.last_check = time.time()
+        for path, mtime in self.mtimes.items():
+            try:
+                if os.stat(path).st_mtime == mtime:
+                    continue
+            except OSError:
+                pass
+            self.reload()
+            return True
+        return changed
+
+    def _load_visible(self):
+        directory = self.directory
+        if not directory.files:
+            return False
+        height = 100
+        if self.fm.ui.browser and self.fm.ui.browser.main_column:
+            height = max(self.fm.ui.browser.main_column.hei, 1)
+        start = max(0, directory.pointer - height)
+        changed = False
+        for fobj in directory.files[start : directory.pointer + height]:
+            if not fobj.loaded:
+                fobj.load()
+                changed = True
+        return changed
+
+    def _publish(self, files, filenames):
+        import time
+
+        directory = self.directory
+        if not self.published:
+            for fobj in directory.marked_items:
+                fobj.mark_set(False)
+            del directory.marked_items[:]
+        for fobj in files[self.published :]:
+            marked = fobj.path in self.marked_paths
+            fobj.mark_set(marked)
+            if marked:
+                directory.marked_items.append(fobj)
+        self.published = len(files)
+        directory.files_all = list(files)
+        directory.filenames = list(filenames)
+        directory.size = len(files)
+        directory.infostring = " %d" % len(files)
+        directory.content_loaded = True
+        directory.sort()
+        directory.last_update_time = time.time()
+        self._load_visible()
+
+    def generate(self):
+        # pylint: disable=too-many-locals
+        from ranger.container.file import File
+
+        directory = self.directory
+        root = directory.path
+        prefix_length = len(root.rstrip(os.sep)) + 1
+        need_stat = self.fm.settings.sort in self.stat_sort_keys
+        follow = self.level > 0  # like ranger's walklevel()
+        files = []
+        filenames = []
+        queue = collections.deque([(root, 0)])
+        publish_at = self.first_batch
+        self.marked_paths = set(fobj.path for fobj in directory.marked_items)
+        self.attach()
+        directory.loading = True
+        try:
+            while queue and not self._cancelled:
+                path, depth = queue.popleft()
+                try:
+                    self.mtimes[path] = os.stat(path).st_mtime
+                    entries = list(os.scandir(path))
+                except OSError:
+                    continue
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=follow)
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        fobj = self.fm.get_directory(entry.path, path_is_abs=True)
+                        if self.level == -1 or depth + 1 <= self.level:
+                            queue.append((entry.path, depth + 1))
+                    else:
+                        fobj = File(entry.path, path_is_abs=True)
+                    fobj.relative_path = entry.path[prefix_length:]
+                    if need_stat:
+                        fobj.load()
+                    files.append(fobj)
+                    filenames.append(entry.path)
+                if len(files) >= self.max_entries:
+                    self.truncated = bool(queue) or len(files) > self.max_entries
+                    del files[self.max_entries :]
+                    del filenames[self.max_entries :]
+                    break
+                if len(files) >= publish_at:
+                    self._publish(files, filenames)
+                    publish_at *= 2
+                self.description = "Flattening: %d entries" % len(files)
+                yield
+        finally:
+            directory.loading = False
+            if self.active.get(directory.path) is self:
+                del self.active[directory.path]
+            if not self._discard:
+                self._publish(files, filenames)
+                directory.cycle_list = None
+                directory.correct_pointer()
+                self.fm.ui.redraw_main_column()
+        if self.truncated:
+            self.fm.notify(
+                "Showing the first %d entries only" % self.max_entries, bad=True
+            )
 
 
 class flat(Command):
     """
-    :flat <level>
+    :flat <level> [<max entries>]
 
     Flattens the directory view up to the specified level.
 
         -1 fully flattened
          0 remove flattened view
+
+    The entries show up while the tree is still being walked, and at most
+    <max entries> (max_entries by default) are loaded.
     """
 
+    max_entries = 1000000
+
     def execute(self):
         try:
-            level_str = self.rest(1)
+            level_str = self.arg(1)
             level = int(level_str)
         except ValueError:
             level = self.quantifier
         if level is None:
-            self.fm.notify("Syntax: flat <level>", bad=True)
+            self.fm.notify("Syntax: flat <level> [<max entries>]", bad=True)
             return
         if level < -1:
             self.fm.notify("Need an integer number (-1, 0, 1, ...)", bad=True)
+        try:
+            max_entries = int(self.arg(2)) if self.arg(2) else self.max_entries
+        except ValueError:
+            self.fm.notify("Need an integer number of entries", bad=True)
+            return
+        FlatLoader.stop(self.fm.thisdir)
+        FlatLoader.detach(self.fm.thisdir)
         self.fm.thisdir.unload()
         self.fm.thisdir.flat = level
-        self.fm.thisdir.load_content()
+        if level:
+            FlatLoader.start(self.fm.thisdir, level, max_entries)
+        else:
+            self.fm.thisdir.load_content()
 
 
 class reset_previews(Command):
@@ -1784,6 +4976,185 @@ class reset_previews(Command):
 # --------------------------------
 
 
+def argv_batches(args, max_length):
+    """Split args into lists whose total length stays below max_length"""
+    batch = []
+    length = 0
+    for arg in args:
+        if batch and length + len(arg) + 1 > max_length:
+            yield batch
+            batch = []
+            length = 0
+        batch.append(arg)
+        length += len(arg) + 1
+    if batch:
+        yield batch
+
+
+def parse_git_status(output):
+    """Map the paths in `git status --porcelain=v2 -z` output to their
+    two-letter status codes, as `git status --porcelain` would print them"""
+    statuses = {}
+    records = iter(output.split("\0"))
+    for record in records:
+        kind = record[:1]
+        if kind in ("?", "!"):
+            statuses[os.path.normpath(record[2:])] = kind * 2
+            continue
+        if kind == "1":
+            fields = record.split(" ", 8)
+        elif kind == "2":
+            fields = record.split(" ", 9)
+            next(records, None)  # the original path
+        elif kind == "u":
+            fields = record.split(" ", 10)
+        else:
+            continue
+        statuses[os.path.normpath(fields[-1])] = fields[1].replace(".", " ")
+    return statuses
+
+
+class GitActionLoader(Loadable, FileManagerAware):
+    """Runs `git add` or `git reset` on a list of files in the background
+
+    The paths are passed in batches that fit on a command line.
+    Afterwards, `git status` is asked about just these paths, and the
+    statuses ranger knows of are updated from that: the root's list of
+    changed paths, the touched files and the directories above them.
+    """
+
+    max_arg_length = 100000
+
+    def __init__(self, rootvcs, args, paths, descr):
+        self.rootvcs = rootvcs
+        self.args = args
+        self.paths = paths
+        self.errors = []
+        self._cancelled = False
+        Loadable.__init__(self, self.generate(), descr)
+
+    def destroy(self):
+        self._cancelled = True
+
+    def _git(self, args):
+        process = subprocess.Popen(
+            ["git", "--literal-pathspecs"] + args,
+            cwd=self.rootvcs.path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        stdout, stderr = process.communicate()
+        if process.returncode:
+            self.errors.append(stderr.decode("utf-8", "replace").strip())
+        return stdout.decode("utf-8", "surrogateescape")
+
+    def generate(self):
+        from concurrent.futures import ThreadPoolExecutor, wait
+
+        root = self.rootvcs.path
+        relpaths = [os.path.relpath(path, root) for path in self.paths]
+        # Collapsed untracked or ignored directories above the paths have
+        # to be asked about again, too
+        known = self.rootvcs.status_subpaths
+        query = set(relpaths)
+        if known is not None:
+            for relpath in relpaths:
+                parent = os.path.dirname(relpath)
+                while parent:
+                    if parent in known:
+                        query.add(parent)
+                    parent = os.path.dirname(parent)
+        query = sorted(query)
+
+        output = []
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            for batch in argv_batches(relpaths, self.max_arg_length):
+                future = pool.submit(self._git, self.args + ["--"] + batch)
+                while not wait([future], timeout=0.05).done:
+                    yield
+                if self._cancelled:
+                    break
+            else:
+                if known is not None:
+                    status_args = ["status", "--porcelain=v2", "-z", "--ignored"]
+                    for batch in argv_batches(query, self.max_arg_length):
+                        future = pool.submit(self._git, status_args + ["--"] + batch)
+                        while not wait([future], timeout=0.05).done:
+                            yield
+                        output.append(future.result())
+
+        if self.errors:
+            self.fm.notify("git: " + self.errors[0], bad=True)
+        if output:
+            self.update_statuses(query, parse_git_status("\0".join(output)))
+        else:
+            self.fm.ui.vcsthread.process(self.fm.thisdir)
+
+    def update_statuses(self, relpaths, codes):
+        rootvcs = self.rootvcs
+        known = rootvcs.status_subpaths
+        prefixes = tuple(relpath + "/" for relpath in relpaths)
+        for relpath in [key for key in known if key.startswith(prefixes)]:
+            del known[relpath]
+        for relpath in relpaths:
+            known.pop(relpath, None)
+        for relpath, code in codes.items():
+            known[relpath] = rootvcs._status_translate(code)
+        rootvcs.obj.vcsstatus = rootvcs._status_root()
+
+        # The loaded directories that show one of the paths, one of their
+        # parents or something inside them
+        touched = set(os.path.join(rootvcs.path, relpath) for relpath in relpaths)
+        above = set()
+        for path in touched:
+            path = os.path.dirname(path)
+            while path not in above:
+                above.add(path)
+                if path == rootvcs.path:
+                    break
+                path = os.path.dirname(path)
+        inside = tuple(path + "/" for path in touched)
+        for dirpath, directory in list(self.fm.directories.items()):
+            if dirpath in touched or dirpath.startswith(inside):
+                relevant = None
+            elif dirpath in above:
+                relevant = touched | above
+            else:
+                continue
+            if not directory.files_all or not directory.vcs or not directory.vcs.track:
+                continue
+            for fobj in directory.files_all:
+                if relevant is not None and fobj.path not in relevant:
+                    continue
+                path = os.path.join(directory.realpath, fobj.basename)
+                if fobj.is_directory:
+                    if fobj.vcs and fobj.vcs.track and not fobj.vcs.is_root_pointer:
+                        fobj.vcsstatus = rootvcs.status_subpath(path, is_directory=True)
+                else:
+                    fobj.vcsstatus = rootvcs.status_subpath(path)
+        self.fm.ui.redraw_main_column()
+
+
+def vcs_action(fm, git_args, method, what):
+    """Run a VCS action on the selection, in the background for git"""
+    from ranger.ext.vcs import VcsError
+
+    vcs = fm.thisdir.vcs
+    if not vcs or not vcs.track:
+        fm.notify("Unable to {0} files: Not in repository".format(what))
+        return
+    filelist = [f.path for f in fm.thistab.get_selection()]
+    if vcs.repotype == "git" and filelist:
+        descr = "git {0} {1} files".format(git_args[0], len(filelist))
+        fm.loader.add(GitActionLoader(vcs.rootvcs, git_args, filelist, descr))
+        return
+    try:
+        getattr(vcs, method)(filelist)
+    except VcsError as ex:
+        fm.notify("Unable to {0} files: {1}".format(what, ex))
+    fm.ui.vcsthread.process(fm.thisdir)
+
+
 class stage(Command):
     """
     :stage
@@ -1792,17 +5163,7 @@ class stage(Command):
     """
 
     def execute(self):
-        from ranger.ext.vcs import VcsError
-
-        if self.fm.thisdir.vcs and self.fm.thisdir.vcs.track:
-            filelist = [f.path for f in self.fm.thistab.get_selection()]
-            try:
-                self.fm.thisdir.vcs.action_add(filelist)
-            except VcsError as ex:
-                self.fm.notify("Unable to stage files: {0}".format(ex))
-            self.fm.ui.vcsthread.process(self.fm.thisdir)
-        else:
-            self.fm.notify("Unable to stage files: Not in repository")
+        vcs_action(self.fm, ["add", "--all"], "action_add", "stage")
 
 
 class unstage(Command):
@@ -1813,23 +5174,156 @@ class unstage(Command):
     """
 
     def execute(self):
-        from ranger.ext.vcs import VcsError
-
-        if self.fm.thisdir.vcs and self.fm.thisdir.vcs.track:
-            filelist = [f.path for f in self.fm.thistab.get_selection()]
-            try:
-                self.fm.thisdir.vcs.action_reset(filelist)
-            except VcsError as ex:
-                self.fm.notify("Unable to unstage files: {0}".format(ex))
-            self.fm.ui.vcsthread.process(self.fm.thisdir)
-        else:
-            self.fm.notify("Unable to unstage files: Not in repository")
+        vcs_action(self.fm, ["reset", "--quiet"], "action_reset", "unstage")
 
 
 # Metadata commands
 # --------------------------------
 
 
+class MetadataIndex(MetadataManager, FileManagerAware):
+    """Ranger's metadata manager, with writes batched and lookups cached
+
+    Changes are kept in memory until flush() writes each changed
+    .metadata.json once, which the metadata commands do when a
+    prompt_metadata chain is done.  Files without metadata are
+    remembered too, as are the .metadata.json files that do not exist,
+    so that drawing a metadata linemode (with metadata_deep_search, for
+    every parent directory) does not test for them over and over.  At
+    most every recheck_interval seconds, the directories of the missing
+    .metadata.json files are looked at again, and if one has changed,
+    the files without metadata are forgotten.
+    """
+
+    recheck_interval = 1.0
+
+    def __init__(self, manager):
+        import atexit
+
+        MetadataManager.__init__(self)
+        self.deep_search = manager.deep_search
+        self.metadata_cache = manager.metadata_cache
+        self.metafile_cache = manager.metafile_cache
+        self._missing = set()
+        self._absent = {}
+        self._checked = 0
+        self._dirty = set()
+        atexit.register(self._flush_at_exit)
+
+    def reset(self):
+        self.flush()
+        MetadataManager.reset(self)
+        self._missing.clear()
+        self._absent.clear()
+
+    def _recheck(self):
+        """Forget the misses if a missing .metadata.json may exist now"""
+        import time
+
+        now = time.time()
+        if now - self._checked < self.recheck_interval:
+            return
+        self._checked = now
+        for metafile, mtime in list(self._absent.items()):
+            try:
+                changed = os.stat(os.path.dirname(metafile)).st_mtime != mtime
+            except OSError:
+                changed = mtime is not None
+            if changed:
+                del self._absent[metafile]
+                self._missing.clear()
+
+    def get_metadata(self, filename):
+        self._recheck()
+        if filename in self._missing:
+            return DefaultOpenStruct()
+        try:
+            return DefaultOpenStruct(self._get_entry(filename))
+        except KeyError:
+            self._missing.add(filename)
+            return DefaultOpenStruct()
+
+    def _set_metadata_raw(self, filename, update_dict, metafile):
+        entries = self._get_metafile_content(metafile)
+        name = os.path.basename(filename)
+        entry = entries.get(filename)
+        if entry is None:
+            entry = entries.setdefault(name, {})
+        entry.update(update_dict)
+
+        # Delete key if the value is empty
+        for key, value in update_dict.items():
+            if value == "":
+                del entry[key]
+
+        # If file's metadata become empty after an update, remove it entirely
+        if not entry:
+            if entries.pop(filename, None) is None:
+                entries.pop(name, None)
+
+        self.metadata_cache[filename] = entry
+        self.metafile_cache[metafile] = entries
+        self._absent.pop(metafile, None)
+        # With deep search, an entry may apply to files in subdirectories
+        self._missing.clear()
+        self._dirty.add(metafile)
+
+    def _get_metafile_content(self, metafile):
+        try:
+            return self.metafile_cache[metafile]
+        except KeyError:
+            pass
+        if metafile in self._absent:
+            return {}
+        try:
+            mtime = os.stat(os.path.dirname(metafile)).st_mtime
+        except OSError:
+            mtime = None
+        entries = MetadataManager._get_metafile_content(self, metafile)
+        if metafile not in self.metafile_cache:
+            self._absent[metafile] = mtime
+        return entries
+
+    def _flush_at_exit(self):
+        # The UI is gone by now, so errors can only go to stderr
+        import sys
+
+        self.flush(lambda message: print(message, file=sys.stderr))
+
+    def flush(self, report=None):
+        """Write the changed .metadata.json files
+
+        Errors are passed to report(message), or shown with fm.notify.
+        """
+        import json
+
+        while self._dirty:
+            metafile = self._dirty.pop()
+            tmpname = metafile + ".tmp"
+            try:
+                with open(tmpname, "w") as fobj:
+                    json.dump(
+                        self.metafile_cache[metafile],
+                        fobj,
+                        check_circular=True,
+                        indent=2,
+                    )
+                os.rename(tmpname, metafile)
+            except (OSError, IOError) as err:
+                message = "Failed to write %s: %s" % (metafile, err)
+                if report is None:
+                    self.fm.notify(message, bad=True)
+                else:
+                    report(message)
+
+
+def metadata_index(fm):
+    """Put a MetadataIndex in place of fm.metadata, return it"""
+    if not isinstance(fm.metadata, MetadataIndex):
+        fm.metadata = MetadataIndex(fm.metadata)
+    return fm.metadata
+
+
 class prompt_metadata(Command):
     """
     :prompt_metadata <key1> [<key2> [<key3> ...]]
@@ -1841,6 +5335,8 @@ class prompt_metadata(Command):
     _console_chain = None
 
     def execute(self):
+        # Write what an abandoned chain left behind
+        metadata_index(self.fm).flush()
         prompt_metadata._console_chain = self.args[1:]
         self._process_command_stack()
 
@@ -1849,6 +5345,7 @@ class prompt_metadata(Command):
             key = prompt_metadata._console_chain.pop()
             self._fill_console(key)
         else:
+            metadata_index(self.fm).flush()
             for col in self.fm.ui.browser.columns:
                 col.need_redraw = True
 
@@ -1874,8 +5371,9 @@ class meta(prompt_metadata):
         update_dict = dict()
         update_dict[key] = self.rest(2)
         selection = self.fm.thistab.get_selection()
+        metadata = metadata_index(self.fm)
         for fobj in selection:
-            self.fm.metadata.set_metadata(fobj.path, update_dict)
+            metadata.set_metadata(fobj.path, update_dict)
         self._process_command_stack()
 
     def tab(self, tabnum):
@@ -1909,12 +5407,74 @@ class linemode(default_linemode):
         if mode not in self.fm.thisfile.linemode_dict:
             self.fm.notify("Unhandled linemode: `%s'" % mode, bad=True)
             return
+        if self.fm.thisfile.linemode_dict[mode].uses_metadata:
+            metadata_index(self.fm)
+        cache_linemodes(self.fm)
 
         self.fm.thisdir.set_linemode_of_children(mode)
 
-        # Ask the browsercolumns to redraw
+        # Only the columns that show this directory have changed
         for col in self.fm.ui.browser.columns:
-            col.need_redraw = True
+            if col.target is self.fm.thisdir:
+                col.need_redraw = True
+
+
+class ClipboardWriter(FileManagerAware):
+    """Writes to the clipboards on a thread of its own
+
+    Only the latest text waiting to be written matters, so yanking again
+    before the previous write is done replaces it instead of queueing
+    another round of clipboard processes.  Failures are reported through
+    MainLoopCalls, so they show up right away.
+    """
+
+    def __init__(self, commands):
+        import threading
+
+        MainLoopCalls.install(self.fm)
+        self.commands = commands
+        self._pending = None
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, text):
+        with self._condition:
+            self._pending = text
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                text = self._pending
+                self._pending = None
+            errors = []
+            for command in self.commands:
+                try:
+                    with open(os.devnull, "w") as devnull:
+                        process = subprocess.Popen(
+                            command,
+                            universal_newlines=True,
+                            stdin=subprocess.PIPE,
+                            stdout=devnull,
+                            stderr=devnull,
+                        )
+                        process.communicate(input=text)
+                except OSError as err:
+                    errors.append("%s: %s" % (" ".join(command), err))
+                    continue
+                if process.returncode:
+                    errors.append(
+                        "%s exited with %d" % (" ".join(command), process.returncode)
+                    )
+            if errors:
+                MainLoopCalls.call(self._report, "; ".join(errors))
+
+    def _report(self, error):
+        self.fm.notify("Failed to yank: " + error, bad=True)
 
 
 class yank(Command):
@@ -1932,46 +5492,45 @@ class yank(Command):
         "path": "path",
     }
 
-    def execute(self):
-        import subprocess
+    # The writer for the clipboard commands found, on the first yank
+    writer = None
 
-        def clipboards():
-            from ranger.ext.get_executables import get_executables
-
-            clipboard_managers = {
-                "xclip": [
-                    ["xclip"],
-                    ["xclip", "-selection", "clipboard"],
-                ],
-                "xsel": [
-                    ["xsel"],
-                    ["xsel", "-b"],
-                ],
-                "wl-copy": [
-                    ["wl-copy"],
-                ],
-                "pbcopy": [
-                    ["pbcopy"],
-                ],
-            }
-            ordered_managers = ["pbcopy", "wl-copy", "xclip", "xsel"]
-            executables = get_executables()
-            for manager in ordered_managers:
-                if manager in executables:
-                    return clipboard_managers[manager]
-            return []
+    @staticmethod
+    def clipboards():
+        from ranger.ext.get_executables import get_executables
 
-        clipboard_commands = clipboards()
+        clipboard_managers = {
+            "xclip": [
+                ["xclip"],
+                ["xclip", "-selection", "clipboard"],
+            ],
+            "xsel": [
+                ["xsel"],
+                ["xsel", "-b"],
+            ],
+            "wl-copy": [
+                ["wl-copy"],
+            ],
+            "pbcopy": [
+                ["pbcopy"],
+            ],
+        }
+        ordered_managers = ["pbcopy", "wl-copy", "xclip", "xsel"]
+        executables = get_executables()
+        for manager in ordered_managers:
+            if manager in executables:
+                return clipboard_managers[manager]
+        return []
+
+    def execute(self):
+        if yank.writer is None:
+            yank.writer = ClipboardWriter(self.clipboards())
 
         mode = self.modes[self.arg(1)]
         selection = self.get_selection_attr(mode)
 
         new_clipboard_contents = "\n".join(selection)
-        for command in clipboard_commands:
-            process = subprocess.Popen(
-                command, universal_newlines=True, stdin=subprocess.PIPE
-            )
-            process.communicate(input=new_clipboard_contents)
+        yank.writer.write(new_clipboard_contents)
 
     def get_selection_attr(self, attr):
         return [getattr(item, attr) for item in self.fm.thistab.get_selection()]
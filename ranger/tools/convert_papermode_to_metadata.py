@@ -1,10 +1,16 @@
 #!/usr/bin/env python
 """
 usage: ./convert_papermode_to_metadata.py
+       ./convert_papermode_to_metadata.py -r [-j <jobs>] [<root>]
 
 This script converts the .paperinfo CSV file in the current directory to an
 equivalent .metadata.json file.
 
+With -r, every .paperinfo below <root> (default: the current directory) is
+converted, in parallel on <jobs> processes (default: one per CPU).  Instead of
+asking whether to overwrite an existing .metadata.json, its entries are kept
+and the ones from .paperinfo are merged into them.
+
 ranger used to store metadata in .paperinfo files, but that format was rather
 limited, so .metadata.json files were introduced.
 """
@@ -15,35 +21,29 @@ import csv
 import json
 import os
 import sys
+import time
 
 if sys.version_info[0] < 3:
     input = raw_input  # NOQA pylint: disable=undefined-variable,redefined-builtin,invalid-name
 
 
 FIELDS = ["name", "year", "title", "authors", "url"]
+SOURCE_NAME = ".paperinfo"
+TARGET_NAME = ".metadata.json"
 
 
-def replace(source, target):
-    if not os.path.exists(source):
-        print("Source file `%s' doesn't exist, skipping." % source)
-        return
+def read_paperinfo(source, result, messages):
+    """Add the entries of the source file to the result dictionary
 
-    # Ask for user confirmation if the target file already exists
-    if os.path.exists(target):
-        sys.stdout.write("Warning: target file `%s' exists! Overwrite? [y/N]")
-        userinput = input()
-        if not (userinput.startswith("y") or userinput.startswith("Y")):
-            print("Skipping file `%s'" % source)
-            return
-
-    result = dict()
-
-    # Read the input file and convert it to a dictionary
-    with open(".paperinfo", "r") as infile:
+    Returns the number of entries read.
+    """
+    count = 0
+    with open(source, "r") as infile:
         reader = csv.reader(infile, skipinitialspace=True)
         for lineno, row in enumerate(reader):
             if len(row) != len(FIELDS):
-                print("skipping invalid row `%s' on line %d" % (row, lineno))
+                messages.append("skipping invalid row `%s' on line %d of `%s'"
+                                % (row, lineno, source))
                 continue
             name = row[0]
             entry = {}
@@ -55,18 +55,134 @@ def replace(source, target):
 
             # Adding the dict if it isn't empty
             if entry:
-                result[name] = entry
+                result.setdefault(name, {}).update(entry)
+                count += 1
+    return count
+
+
+def write_metadata(target, result):
+    """Write the dictionary to the target file through a temporary file, so
+    that an interrupted conversion never leaves a truncated file behind"""
+    tmpname = target + ".tmp"
+    with open(tmpname, "w") as outfile:
+        json.dump(result, outfile, indent=2)
+    os.rename(tmpname, target)
+
+
+def replace(source, target):
+    if not os.path.exists(source):
+        print("Source file `%s' doesn't exist, skipping." % source)
+        return
+
+    # Ask for user confirmation if the target file already exists
+    if os.path.exists(target):
+        sys.stdout.write("Warning: target file `%s' exists! Overwrite? [y/N]" % target)
+        userinput = input()
+        if not (userinput.startswith("y") or userinput.startswith("Y")):
+            print("Skipping file `%s'" % source)
+            return
+
+    result = dict()
+    messages = []
+
+    # Read the input file and convert it to a dictionary
+    read_paperinfo(source, result, messages)
+    for message in messages:
+        print(message)
 
     # Write the obtained dictionary into the target file
     if result:
-        with open(".metadata.json", "w") as outfile:
-            json.dump(result, outfile, indent=2)
+        write_metadata(target, result)
     else:
         print("Skipping writing `%s' due to a lack of data" % target)
 
 
+def merge(directory):
+    """Merge the .paperinfo of a directory into its .metadata.json
+
+    Returns the directory, the number of entries converted (0 if nothing
+    was written), the size of the .paperinfo and the messages for the user.
+    """
+    source = os.path.join(directory, SOURCE_NAME)
+    target = os.path.join(directory, TARGET_NAME)
+    messages = []
+    try:
+        size = os.path.getsize(source)
+        try:
+            with open(target, "r") as infile:
+                result = json.load(infile)
+        except (IOError, OSError):
+            result = dict()
+        if not isinstance(result, dict):
+            raise ValueError("`%s' doesn't contain a JSON object" % target)
+        count = read_paperinfo(source, result, messages)
+        if count:
+            write_metadata(target, result)
+        else:
+            messages.append("Skipping writing `%s' due to a lack of data" % target)
+    except (IOError, OSError, ValueError) as ex:
+        messages.append("Failed converting `%s': %s" % (source, ex))
+        return directory, 0, 0, messages
+    return directory, count, size, messages
+
+
+def find_paperinfo(root):
+    for dirpath, _, filenames in os.walk(root):
+        if SOURCE_NAME in filenames:
+            yield dirpath
+
+
+def convert_tree(root, jobs=None):
+    from multiprocessing import Pool
+
+    time1 = time.time()
+    files = entries = size = 0
+    pool = Pool(jobs)
+    try:
+        for _, count, nbytes, messages in pool.imap_unordered(
+                merge, find_paperinfo(root), chunksize=16):
+            for message in messages:
+                print(message)
+            if count:
+                files += 1
+            entries += count
+            size += nbytes
+    finally:
+        pool.close()
+        pool.join()
+    time2 = time.time()
+
+    seconds = max(time2 - time1, 1e-6)
+    print("Converted %d files with %d entries (%.1f MB) in %.2fs: "
+          "%.0f files/s, %.0f entries/s, %.1f MB/s"
+          % (files, entries, size / 1e6, seconds, files / seconds,
+             entries / seconds, size / 1e6 / seconds))
+
+
+def main():
+    args = sys.argv[1:]
+    if "-r" not in args:
+        replace(SOURCE_NAME, TARGET_NAME)
+        return
+    args.remove("-r")
+
+    jobs = None
+    if "-j" in args:
+        i = args.index("-j")
+        try:
+            jobs = int(args[i + 1])
+            if jobs < 1:
+                raise ValueError
+        except (IndexError, ValueError):
+            print("-j needs a positive number of jobs")
+            sys.exit(1)
+        del args[i:i + 2]
+    root = args[0] if args else "."
+    convert_tree(root, jobs)
+
+
 if __name__ == "__main__":
     if set(['--help', '-h']) & set(sys.argv[1:]):
         print(__doc__.strip())
     else:
-        replace(".paperinfo", ".metadata.json")
+        main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+usage: ./scout_invert_benchmark.py [<directory>]
+
+Compares the two ways of implementing ":scout -v": wrapping the pattern in
+a negative lookahead (the old way) and running the positive pattern and
+negating the result (what scout does now).
+
+The names are read from <directory> if given, otherwise 200000 synthetic
+file names are generated.
+"""
+
+from __future__ import (absolute_import, division, print_function)
+
+import os
+import re
+import sys
+import time
+
+COUNT = 200000
+PATTERNS = ["dump", "2019", "part_1.*gz", "[0-9]{6}"]
+
+
+def synthetic_names(count):
+    return ["dataset_dump_%06d_part_%d_of_some_long_experiment_name.tar.gz"
+            % (i, i % 7) for i in range(count)]
+
+
+def measure(search, names):
+    time1 = time.time()
+    matches = sum(1 for name in names if search(name))
+    time2 = time.time()
+    return matches, (time2 - time1) * 1000
+
+
+def main():
+    if len(sys.argv) > 1:
+        names = os.listdir(sys.argv[1])
+    else:
+        names = synthetic_names(COUNT)
+    print("%d names" % len(names))
+
+    for pattern in PATTERNS:
+        lookahead = re.compile("^(?:(?!%s).)*$" % pattern, re.UNICODE)
+        positive = re.compile(pattern, re.UNICODE)
+
+        def negated(name):
+            return not positive.search(name)  # pylint: disable=cell-var-from-loop
+
+        old_matches, old_ms = measure(lookahead.search, names)
+        new_matches, new_ms = measure(negated, names)
+        assert old_matches == new_matches
+        print("%-12s %8d matches  lookahead: %7dms  negated: %7dms  (%.1fx)"
+              % (pattern, new_matches, old_ms, new_ms, old_ms / max(new_ms, 1)))
+
+
+if __name__ == '__main__':
+    if set(['--help', '-h']) & set(sys.argv[1:]):
+        print(__doc__.strip())
+    else:
+        main()